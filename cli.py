@@ -1,15 +1,167 @@
 """Some random utils for writing command line scripts"""
 
+import io
 import os
 import sys
+import bz2
+import json
+import time
+import random
+import glob
+import gzip
+import mmap
+from collections import Counter, defaultdict
 from contextlib import contextmanager
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# Size of the reads done on compressed input
+BUFFER_SIZE = 1024 * 1024
+
+# Leading bytes that identify compressed files
+COMPRESSION_MAGIC = (
+    ('gzip', '\x1f\x8b'),
+    ('bz2', 'BZh'),
+    ('xz', '\xfd7zXZ\x00'),
+)
+
 
 class CliError(Exception):
     """A base cli exception"""
     pass
 
 
+class MappedFile(object):
+    """Read only file like object over a memory mapped file"""
+
+    def __init__(self, f):
+        self.f = f
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __iter__(self):
+        return iter(self.mm.readline, '')
+
+    def readline(self):
+        return self.mm.readline()
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.mm.size() - self.mm.tell()
+        return self.mm.read(size)
+
+    def seek(self, pos, whence=0):
+        self.mm.seek(pos, whence)
+
+    def tell(self):
+        return self.mm.tell()
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+
+class ChainedInput(object):
+    """File like object that reads a number of input files one after
+    the other. Each file is opened only when it's reached
+
+    """
+
+    def __init__(self, filepaths):
+        self.filepaths = filepaths
+
+    def __iter__(self):
+        for filepath in self.filepaths:
+            f = open_input(filepath)
+            try:
+                for line in f:
+                    yield line
+            finally:
+                f.close()
+
+    def read(self):
+        return ''.join(self)
+
+    def close(self):
+        pass
+
+
+def compression(filepath):
+    """Detects the compression of a file from its leading bytes
+
+    :param filepath: str
+
+    :rtype: str, one of `gzip`, `bz2`, `xz` or None if the file is
+            not compressed
+
+    """
+    with open(filepath, 'rb') as f:
+        head = f.read(6)
+    for name, magic in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def open_input(filepath):
+    """Opens a file for reading, decompressing it on the fly if it's
+    gzip, bz2 or xz compressed. Uncompressed files are memory mapped
+
+    :param filepath: str
+
+    :rtype: file like object
+
+    """
+    filepath = os.path.abspath(filepath)
+    kind = compression(filepath)
+    if kind == 'gzip':
+        return io.BufferedReader(gzip.open(filepath, 'rb'), BUFFER_SIZE)
+    elif kind == 'bz2':
+        return bz2.BZ2File(filepath, 'rb', BUFFER_SIZE)
+    elif kind == 'xz':
+        if lzma is None:
+            raise CliError('Reading xz files requires the lzma module '
+                           '(backports.lzma on python 2)')
+        return io.BufferedReader(lzma.LZMAFile(filepath, 'rb'), BUFFER_SIZE)
+    f = open(filepath, 'rb')
+    if os.fstat(f.fileno()).st_size == 0:
+        # empty files can't be memory mapped
+        return f
+    return MappedFile(f)
+
+
+def expand_paths(filepaths):
+    """Expands the glob patterns in a list of filepaths
+
+    Paths are kept in the given order and the matches of each glob are
+    sorted. Raises an exception if a path or glob doesn't match any
+    file
+
+    :param filepaths: str or list of str
+
+    :rtype: list of str
+
+    """
+    if isinstance(filepaths, basestring):
+        filepaths = [filepaths]
+    expanded = []
+    for filepath in filepaths:
+        if os.path.exists(filepath):
+            expanded.append(filepath)
+            continue
+        matches = sorted(glob.glob(filepath))
+        if not matches:
+            raise CliError('No such file: %s' % (filepath,))
+        expanded.extend(matches)
+    return expanded
+
+
 @contextmanager
 def read_input(filepath, stdin):
     """Contextmanager that gets a file like object as source
@@ -19,19 +171,190 @@ def read_input(filepath, stdin):
     input if stdin is True Raises an exception if both above cases
     fail
 
-    :param filepath: str
+    filepath may also be a list of paths and may contain glob
+    patterns, in which case all the files are read one after the
+    other. Compressed files (gzip, bz2 and xz) are decompressed on the
+    fly.
+
+    :param filepath: str or list of str
 
     :param stdin: bool
 
     :rtype: file like object to be used with `with` keyword
 
     """
-    if filepath is not None:
-        f = open(os.path.abspath(filepath))
-        yield f
-        f.close()
+    if filepath:
+        filepaths = expand_paths(filepath)
+        if len(filepaths) == 1:
+            f = open_input(filepaths[0])
+        else:
+            f = ChainedInput(filepaths)
+        try:
+            yield f
+        finally:
+            f.close()
     elif stdin:
         yield sys.stdin
     else:
         raise CliError('Either filepath or stdin required')
 
+
+
+def byte_ranges(filepath, chunk_size):
+    """Splits a file into ranges of roughly chunk_size bytes such that
+    each range starts at the beginning of a line and ends right after
+    a newline (or at the end of the file)
+
+    :param filepath: str
+
+    :param chunk_size: int
+
+    :rtype: list of (start, end) tuples
+
+    """
+    size = os.path.getsize(filepath)
+    ranges = []
+    start = 0
+    with open(filepath, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def read_range(filepath, start, end):
+    """Reads the bytes between start and end of a file and returns a
+    file like object that can be iterated over line by line
+
+    :param filepath: str
+
+    :param start: int
+
+    :param end: int
+
+    :rtype: file like object
+
+    """
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        return io.BytesIO(f.read(end - start))
+
+
+class PipelineStats(object):
+    """Opt-in instrumentation for scripts that process input line by
+    line
+
+    Keeps counters (eg. lines read, matched, rejected), the time spent
+    in each stage of the processing and a random sample of up to
+    `sample_size` values per kind (eg. the rejected lines) for
+    debugging. Stats collected in other processes can be combined
+    using `merge`.
+
+    :param counters: names of the counters to report even if they are
+                     zero
+
+    :param sample_size: int
+
+    """
+
+    def __init__(self, counters=(), sample_size=10):
+        self.sample_size = sample_size
+        self.counters = Counter(dict((name, 0) for name in counters))
+        self.timings = defaultdict(float)
+        self.samples = defaultdict(list)
+        self.seen = Counter()
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] += seconds
+
+    def sample(self, name, value):
+        """Reservoir sampling of the values of a kind"""
+        self.seen[name] += 1
+        samples = self.samples[name]
+        if len(samples) < self.sample_size:
+            samples.append(value)
+        else:
+            i = random.randint(0, self.seen[name] - 1)
+            if i < self.sample_size:
+                samples[i] = value
+
+    def timed_lines(self, lines):
+        """Generator that counts the lines and bytes read from lines
+        and adds the time spent reading them to the `read` stage
+
+        :param lines: iterable of str
+
+        :rtype: generator of str
+
+        """
+        lines = iter(lines)
+        while True:
+            start = time.time()
+            try:
+                line = next(lines)
+            except StopIteration:
+                self.timings['read'] += time.time() - start
+                return
+            self.timings['read'] += time.time() - start
+            self.counters['lines'] += 1
+            self.counters['bytes'] += len(line)
+            yield line
+
+    def merge(self, other):
+        """Adds the counters, timings and samples of other, as returned
+        by `as_dict`, to these stats
+
+        :param other: dict
+
+        :rtype: None
+
+        """
+        self.counters.update(other['counters'])
+        for stage, seconds in other['timings'].iteritems():
+            self.timings[stage] += seconds
+        for name, values in other['samples'].iteritems():
+            for value in values:
+                self.sample(name, value)
+
+    def as_dict(self):
+        elapsed = time.time() - self.started
+        return {
+            'elapsed': elapsed,
+            'counters': dict(self.counters),
+            'timings': dict(self.timings),
+            'bytes_per_sec': self.counters['bytes'] / elapsed if elapsed else 0,
+            'lines_per_sec': self.counters['lines'] / elapsed if elapsed else 0,
+            'samples': dict(self.samples),
+        }
+
+    def report(self, out=sys.stderr):
+        """Writes a human readable summary to out, stderr by default"""
+        stats = self.as_dict()
+        elapsed = stats['elapsed']
+        out.write('Elapsed: %.2fs, %.0f lines/sec, %.2f MB/sec\n' % (
+            elapsed, stats['lines_per_sec'],
+            stats['bytes_per_sec'] / (1024 * 1024)))
+        for name in sorted(self.counters):
+            out.write('  %-20s %d\n' % (name, self.counters[name]))
+        out.write('Time spent per stage:\n')
+        for stage in sorted(self.timings, key=self.timings.get,
+                            reverse=True):
+            seconds = self.timings[stage]
+            out.write('  %-20s %8.2fs %5.1f%%\n' % (
+                stage, seconds, 100 * seconds / elapsed if elapsed else 0))
+        for name in sorted(self.samples):
+            out.write('Sample of %s:\n' % (name,))
+            for value in self.samples[name]:
+                out.write('  %r\n' % (value,))
+
+    def dump(self, filepath):
+        """Writes the stats to a file as json"""
+        with open(filepath, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
@@ -7,17 +7,53 @@ For help, run following command in terminal::
 """
 
 import datetime
+import calendar
 import argparse
 import re
+import os
 import sys
+import glob
 import json
+import time
+import itertools
+import multiprocessing
 
 import cli
+import logcolumns
 from dateutil import tz, parser as dateparser
 
 
+class LogPattern(object):
+    """A predefined log pattern
+
+    Along with the regex, it has cheap checks that reject most of the
+    lines that can't match (junk lines, lines of other log formats)
+    before the regex is tried on them
+
+    :param pattern: str, the regex
+    :param first_chars: str, characters that a matching line may start
+                        with [default: None]
+    :param contains: str, a substring that every matching line has
+                     [default: None]
+
+    """
+
+    def __init__(self, pattern, first_chars=None, contains=None):
+        self.regex = re.compile(pattern)
+        self.pattern = self.regex.pattern
+        self.first_chars = frozenset(first_chars) if first_chars else None
+        self.contains = contains
+
+    def match(self, line):
+        if self.first_chars is not None and line[:1] not in self.first_chars:
+            return None
+        if self.contains is not None and self.contains not in line:
+            return None
+        return self.regex.match(line)
+
+
 LOG_PATTERNS = {
-    'apache2_access': re.compile(
+    'apache2_access': LogPattern(
         r'^(?P<ip>[0-9.]+)\s'
         r'-\s-\s'
         r'\[(?P<datetime>.+)\]\s'
@@ -27,10 +63,34 @@ LOG_PATTERNS = {
         r'(?P<status_code>\d{3})\s'
         r'(?P<content_size>\d+)\s'
         r'"(?P<referrer>.+)"\s'
-        r'"(?P<user_agent>.+)"$'
+        r'"(?P<user_agent>.+)"$',
+        first_chars='0123456789',
+        contains='['
+    ),
+    'nginx_access': LogPattern(
+        r'^(?P<ip>[0-9a-fA-F.:]+)\s'
+        r'-\s(?P<remote_user>\S+)\s'
+        r'\[(?P<datetime>[^\]]+)\]\s'
+        r'"(?P<method>[A-Z]+)\s'
+        r'(?P<path>\S+)\s'
+        r'HTTP/(?P<http_ver>\d(\.\d)?)"\s'
+        r'(?P<status_code>\d{3})\s'
+        r'(?P<content_size>\d+)\s'
+        r'"(?P<referrer>[^"]*)"\s'
+        r'"(?P<user_agent>[^"]*)"',
+        first_chars='0123456789abcdefABCDEF:',
+        contains='['
     ),
 }
 
+# Number of lines looked at for detecting the log format
+DETECT_SAMPLE_SIZE = 100
+
+# Order in which ties are broken when detecting the log format, the
+# stricter patterns first as nginx_access matches any line that
+# apache2_access matches
+DETECT_ORDER = ['apache2_access', 'nginx_access']
+
 
 def get_pattern(pattern_arg):
     """Get a predefined or a newly compiled re pattern
@@ -40,7 +100,7 @@ def get_pattern(pattern_arg):
     the string pattern and returns the compiled SRE_Pattern object
 
     :param pattern_arg: str
-    :rtype: SRE_Pattern object
+    :rtype: LogPattern or SRE_Pattern object
 
     """
     if pattern_arg in LOG_PATTERNS:
@@ -49,44 +109,620 @@ def get_pattern(pattern_arg):
         return re.compile(pattern_arg)
 
 
+def detect_pattern(lines, sample_size=DETECT_SAMPLE_SIZE):
+    """Detects the log format by trying all the predefined patterns on
+    the first few non blank lines
+
+    The pattern matching the most lines in the sample is picked. Ties
+    are broken in favour of the pattern that comes first in
+    DETECT_ORDER. Since
+    the sample lines are consumed from `lines`, an iterator over all
+    the lines, including the sample ones, is returned along with the
+    name of the pattern. Raises CliError if no pattern matches any of
+    the sample lines
+
+    :param lines: iterable of str
+    :param sample_size: int
+    :rtype: tuple of (pattern name, iterator of lines)
+
+    """
+    lines = iter(lines)
+    sample = []
+    for line in lines:
+        sample.append(line)
+        if len(sample) >= sample_size:
+            break
+    non_blank = [line for line in sample if line.strip() != '']
+    scores = [(sum(1 for line in non_blank
+                   if LOG_PATTERNS[name].match(line) is not None), name)
+              for name in DETECT_ORDER]
+    best = max(scores, key=lambda x: x[0])
+    if best[0] == 0:
+        raise cli.CliError('Could not detect the log format')
+    return best[1], itertools.chain(sample, lines)
+
+
+EPOCH = datetime.datetime(1970, 1, 1).replace(tzinfo=tz.tzutc())
+
+MONTHS = dict((m, i) for i, m in enumerate(calendar.month_abbr) if m)
+
+# Caches used by `apache_timestamp`. Consecutive lines in access logs
+# mostly share the same second and almost always the same offset, so
+# both stay small and the hit rate is very high. The second cache is
+# simply reset when it grows beyond the limit.
+SECOND_CACHE_SIZE = 4096
+_second_cache = {}
+_offset_cache = {}
+
+
 def datetime_to_timestamp(dt):
     """Converts a utc timezone aware datetime object to utc timestamp"""
-    epoch = datetime.datetime(1970, 1, 1).replace(tzinfo=tz.tzutc())
-    return (dt - epoch).total_seconds()
+    return (dt - EPOCH).total_seconds()
+
+
+def _parse_second(second):
+    """Converts the `08/Nov/2012:13:15:05` part of an apache datetime to
+    seconds since epoch ignoring the timezone. Returns None if the
+    string is not in this format
+
+    """
+    if (len(second) != 20 or second[2] != '/' or second[6] != '/' or
+        second[11] != ':' or second[14] != ':' or second[17] != ':'):
+        return None
+    month = MONTHS.get(second[3:6].title())
+    if month is None:
+        return None
+    try:
+        return calendar.timegm((int(second[7:11]), month, int(second[0:2]),
+                                int(second[12:14]), int(second[15:17]),
+                                int(second[18:20])))
+    except ValueError:
+        return None
+
+
+def _parse_offset(offset):
+    """Converts a timezone offset such as `+0530` to seconds. Returns
+    None if the string is not in this format
+
+    """
+    if len(offset) != 5 or offset[0] not in '+-' or not offset[1:].isdigit():
+        return None
+    seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+    return -seconds if offset[0] == '-' else seconds
+
+
+def apache_timestamp(value):
+    """Converts a datetime str in the apache log format eg.
+    `08/Nov/2012:13:15:05 +0000` to utc timestamp
+
+    Results are cached by the second and by the timezone offset
+    separately. Returns None if the value is not in this format
+
+    :param value: str
+    :rtype: float or None
+
+    """
+    second, _, offset = value.partition(' ')
+    try:
+        ts = _second_cache[second]
+    except KeyError:
+        ts = _parse_second(second)
+        if ts is None:
+            return None
+        if len(_second_cache) >= SECOND_CACHE_SIZE:
+            _second_cache.clear()
+        _second_cache[second] = ts
+    try:
+        delta = _offset_cache[offset]
+    except KeyError:
+        delta = _parse_offset(offset)
+        if delta is None:
+            return None
+        _offset_cache[offset] = delta
+    return float(ts - delta)
+
+
+def parse_timestamp(value):
+    """Converts a datetime str found in the logs to utc timestamp
+
+    Uses `apache_timestamp` and falls back to fuzzy parsing with
+    dateutil for datetimes in any other format
+
+    :param value: str
+    :rtype: float
+
+    """
+    ts = apache_timestamp(value)
+    if ts is None:
+        ts = datetime_to_timestamp(dateparser.parse(value, fuzzy=True))
+    return ts
+
+
+class LogRecord(object):
+    """Compact alternative to the dict that `parse_line` returns, for
+    keeping a large number of parsed logs in memory
+
+    The fields are stored in slots, the values of `ip`, `method` and
+    `http_ver` are interned so that all the records share a single
+    copy of each distinct value, `content_size` is an int and the
+    `datetime` str is dropped in favour of `timestamp`. Fields can be
+    read as attributes or as items, as with the dict, so the records
+    may be passed to the other tools in place of dicts.
+
+    """
+
+    __slots__ = ('ip', 'method', 'path', 'http_ver', 'status_code',
+                 'content_size', 'referrer', 'user_agent', 'timestamp')
+
+    INTERNED = ('ip', 'method', 'http_ver')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_dict(cls, log):
+        """Creates a record from a parsed log dict, such as the ones
+        loaded from the json output of the convert subcommand
+
+        :param log: dict
+        :rtype: LogRecord
+
+        """
+        record = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(record, name, log.get(name))
+        for name in cls.INTERNED:
+            value = getattr(record, name)
+            if value is not None:
+                setattr(record, name, intern(str(value)))
+        if record.content_size is not None:
+            record.content_size = int(record.content_size)
+        if record.timestamp is None and log.get('datetime') is not None:
+            record.timestamp = parse_timestamp(log['datetime'])
+        return record
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
 
+    def keys(self):
+        return list(self.__slots__)
 
-def parse_line(line, pattern):
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return (isinstance(other, LogRecord) and
+                self.to_dict() == other.to_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LogRecord(%s)' % (', '.join('%s=%r' % (name, getattr(self, name))
+                                            for name in self.__slots__),)
+
+
+def parse_line(line, pattern, compact=False, stats=None):
     """Parses a single line using pattern
 
     :param line: str
     :param pattern: SRE_Pattern object
-    :rtype: dict
+    :param compact: bool, return a LogRecord instead of a dict. Only
+                    the fields of the predefined patterns are kept
+    :param stats: cli.PipelineStats, to record the time spent matching
+                  and converting the datetime [default: None]
+    :rtype: dict or LogRecord
     """
+    if stats is not None:
+        start = time.time()
     match = pattern.match(line)
     if match is not None:
         log = match.groupdict()
         # convert status_code to int
         log['status_code'] = int(log['status_code'])
+        if stats is not None:
+            now = time.time()
+            stats.add_time('match', now - start)
+            start = now
         # convert log time to utc timestamp and add to dict
-        dt = dateparser.parse(log['datetime'], fuzzy=True)
-        log['timestamp'] = datetime_to_timestamp(dt)
+        log['timestamp'] = parse_timestamp(log['datetime'])
+        if stats is not None:
+            stats.add_time('datetime', time.time() - start)
+        if compact:
+            return LogRecord.from_dict(log)
         return log
     else:
+        if stats is not None:
+            stats.add_time('match', time.time() - start)
         return None # throw some warning here may be
 
 
+def parse_lines(lines, pattern, compact=False, stats=None):
+    """Generator that parses lines one at a time, skipping the blank
+    lines and the ones that don't match the pattern
+
+    :param lines: iterable of str
+    :param pattern: SRE_Pattern object
+    :param compact: bool, yield LogRecords instead of dicts
+    :param stats: cli.PipelineStats, to count the matched, rejected
+                  and empty lines and sample the rejected ones
+                  [default: None]
+    :rtype: generator of dicts or LogRecords
+
+    """
+    if stats is not None:
+        lines = stats.timed_lines(lines)
+    for line in lines:
+        if line.strip() == '':
+            if stats is not None:
+                stats.count('empty')
+            continue
+        log = parse_line(line, pattern, compact, stats)
+        if log is not None:
+            if stats is not None:
+                stats.count('matched')
+            yield log
+        elif stats is not None:
+            stats.count('rejected')
+            stats.sample('rejected', line)
+
+
+def write_json_array(records, out):
+    """Writes json encoded logs to out as a single json array
+
+    Each record is written as soon as it's produced so that the
+    complete list never has to be held in memory. The output is the
+    same as that of `json.dumps` on the list.
+
+    :param records: iterable of json encoded str
+    :param out: file like object
+    :rtype: None
+
+    """
+    out.write('[')
+    sep = ''
+    for record in records:
+        out.write(sep)
+        out.write(record)
+        sep = ', '
+    out.write(']')
+
+
+def write_ndjson(records, out):
+    """Writes json encoded logs to out as newline delimited json,
+    ie. one json object per line
+
+    :param records: iterable of json encoded str
+    :param out: file like object
+    :rtype: None
+
+    """
+    for record in records:
+        out.write(record)
+        out.write('\n')
+
+
+OUTPUT_WRITERS = {
+    'json': write_json_array,
+    'ndjson': write_ndjson,
+}
+
+
+# Size of the byte ranges that a file is split into when converting
+# in parallel. Many more ranges than processes are created so that the
+# work is evenly spread across the pool
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def convert_range(task):
+    """Parses the lines in a byte range of a file. Runs in the worker
+    processes of `parallel_convert`
+
+    :param task: tuple of (filepath, start, end, pattern_arg, encode,
+                 instrument). If start and end are None, the complete
+                 file is parsed
+    :rtype: tuple of (list of json encoded str or of dicts if encode
+            is False, stats as a dict if instrument is True else None)
+
+    """
+    filepath, start, end, pattern_arg, encode, instrument = task
+    pattern = get_pattern(pattern_arg)
+    stats = cli.PipelineStats() if instrument else None
+    if start is None:
+        with cli.read_input(filepath, False) as lines:
+            logs = list(parse_lines(lines, pattern, stats=stats))
+    else:
+        logs = list(parse_lines(cli.read_range(filepath, start, end),
+                                pattern, stats=stats))
+    if encode:
+        logs = map(json.dumps, logs)
+    return logs, stats.as_dict() if instrument else None
+
+
+def parallel_convert(filepaths, pattern_arg, jobs, ordered=True,
+                     chunk_size=CHUNK_SIZE, encode=True, stats=None):
+    """Generator that parses files using a pool of `jobs` processes,
+    each working on newline aligned byte ranges of the files
+
+    Compressed files can't be split into ranges so each of them is
+    parsed by a single process
+
+    :param filepaths: str or list of str
+    :param pattern_arg: str, name of a predefined pattern or a regex
+    :param jobs: int, number of processes
+    :param ordered: bool, if False, the records are yielded in the
+                    order in which the ranges finish
+    :param chunk_size: int
+    :param encode: bool, if False, the logs are yielded as dicts
+    :param stats: cli.PipelineStats, to merge the stats of the workers
+                  into [default: None]
+    :rtype: generator of json encoded str
+
+    """
+    instrument = stats is not None
+    tasks = []
+    for filepath in cli.expand_paths(filepaths):
+        if cli.compression(filepath) is not None:
+            tasks.append((filepath, None, None, pattern_arg, encode,
+                          instrument))
+        else:
+            tasks.extend((filepath, start, end, pattern_arg, encode,
+                          instrument)
+                         for start, end in cli.byte_ranges(filepath,
+                                                           chunk_size))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for records, range_stats in imap(convert_range, tasks):
+            if instrument:
+                stats.merge(range_stats)
+            for record in records:
+                yield record
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+STATS_COUNTERS = ('lines', 'bytes', 'matched', 'rejected', 'empty')
+
+
+def get_stats(args):
+    """PipelineStats if any of the stats options are given, else None"""
+    if args.stats or args.stats_file:
+        return cli.PipelineStats(STATS_COUNTERS)
+    return None
+
+
+def report_stats(args, stats):
+    """Reports the stats as asked for by the stats options"""
+    if stats is None:
+        return
+    if args.stats:
+        stats.report(sys.stderr)
+    if args.stats_file:
+        stats.dump(args.stats_file)
+
+
 def convert(args):
     """The `convert` subcommand"""
-    pattern = get_pattern(args.pattern)
+    columnar = args.output_format == 'columnar'
+    stats = get_stats(args)
     try:
+        if args.jobs > 1:
+            if not args.filepath:
+                raise cli.CliError('Parallel mode requires a filepath')
+            pattern_arg = args.pattern
+            if pattern_arg == 'auto':
+                with cli.read_input(args.filepath, False) as lines:
+                    pattern_arg = detect_pattern(lines)[0]
+            logs = parallel_convert(args.filepath, pattern_arg, args.jobs,
+                                    ordered=not args.unordered,
+                                    encode=not columnar, stats=stats)
+            if columnar:
+                logcolumns.write_columns(logs, sys.stdout)
+            else:
+                OUTPUT_WRITERS[args.output_format](logs, sys.stdout)
+            report_stats(args, stats)
+            return
         with cli.read_input(args.filepath, args.stdin) as lines:
-            logs = (parse_line(line, pattern)
-                    for line in lines
-                    if line.strip() != '')
-            sys.stdout.write(json.dumps([log for log in logs if log is
-                                         not None]))
+            if args.pattern == 'auto':
+                pattern_arg, lines = detect_pattern(lines)
+            else:
+                pattern_arg = args.pattern
+            logs = parse_lines(lines, get_pattern(pattern_arg), stats=stats)
+            if columnar:
+                logcolumns.write_columns(logs, sys.stdout)
+            else:
+                OUTPUT_WRITERS[args.output_format](
+                    itertools.imap(json.dumps, logs), sys.stdout)
+        report_stats(args, stats)
+    except cli.CliError as e:
+        raise argparse.ArgumentError(None, str(e))
+
+
+# Max number of lines read in one go in follow mode, after which the
+# output is flushed and the checkpoint saved
+FOLLOW_BATCH_SIZE = 10000
+
+
+def load_checkpoint(filepath):
+    """Loads the position saved by `save_checkpoint`
+
+    :param filepath: str
+    :rtype: tuple of (inode, offset) or None if there is no checkpoint
+
+    """
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath) as f:
+        data = json.load(f)
+    return data['inode'], data['offset']
+
+
+def save_checkpoint(filepath, position):
+    """Saves the position in the followed file. The checkpoint file is
+    replaced atomically so that it's never left half written
+
+    :param filepath: str
+    :param position: tuple of (inode, offset)
+    :rtype: None
+
+    """
+    inode, offset = position
+    tmp = filepath + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'inode': inode, 'offset': offset}, f)
+    os.rename(tmp, filepath)
+
+
+def find_rotated(filepath, inode):
+    """Finds the file that a log file with the given inode has been
+    renamed to by logrotate, eg. access.log -> access.log.1
+
+    :param filepath: str
+    :param inode: int
+    :rtype: str or None
+
+    """
+    for candidate in sorted(glob.glob(filepath + '*')):
+        if candidate == filepath:
+            continue
+        try:
+            if (os.stat(candidate).st_ino == inode and
+                cli.compression(candidate) is None):
+                return candidate
+        except (OSError, IOError):
+            continue
+    return None
+
+
+def tail_lines(filepath, position=None, interval=1.0, exit_at_eof=False,
+               batch_size=FOLLOW_BATCH_SIZE):
+    """Generator that follows a growing log file like `tail -F`
+
+    Yields batches of complete lines along with the position right
+    after them, which may be saved and passed back as `position` to
+    resume from there. When the file is renamed (logrotate), the rest
+    of the old file is read before switching to the new one. If the
+    file shrinks (truncation), it's read again from the start. A last
+    line without a newline is yielded once the file is rotated, or at
+    the end with `exit_at_eof`.
+
+    :param filepath: str
+    :param position: tuple of (inode, offset) [default: None]
+    :param interval: float, seconds to wait for new data
+    :param exit_at_eof: bool, stop at the end of the file instead of
+                        waiting for more data
+    :param batch_size: int
+    :rtype: generator of (list of str, (inode, offset))
+
+    """
+    inode, offset = position if position is not None else (None, 0)
+    f = None
+    if inode is not None:
+        rotated = find_rotated(filepath, inode)
+        if rotated is not None:
+            f = open(rotated, 'rb')
+            f.seek(offset)
+    try:
+        while True:
+            if f is None:
+                if not os.path.exists(filepath):
+                    if exit_at_eof:
+                        return
+                    time.sleep(interval)
+                    continue
+                f = open(filepath, 'rb')
+                st = os.fstat(f.fileno())
+                if st.st_ino != inode or st.st_size < offset:
+                    offset = 0
+                inode = st.st_ino
+                f.seek(offset)
+
+            lines = []
+            while len(lines) < batch_size:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    # wait for the rest of a partially written line
+                    f.seek(offset)
+                    break
+                lines.append(line)
+                offset += len(line)
+            if lines:
+                yield lines, (inode, offset)
+                continue
+
+            if os.fstat(f.fileno()).st_size < offset:
+                # truncated in place (copytruncate)
+                f.seek(0)
+                offset = 0
+                continue
+            try:
+                current = os.stat(filepath).st_ino
+            except OSError:
+                current = None
+            rotated = current is not None and current != inode
+            if rotated or exit_at_eof:
+                # nothing more is written to the file, so a last line
+                # without a newline is complete
+                f.seek(offset)
+                rest = f.read()
+                if rest:
+                    offset += len(rest)
+                    yield [rest], (inode, offset)
+            if rotated:
+                # rotated and everything in the old file has been read
+                f.close()
+                f = None
+                inode, offset = None, 0
+            elif exit_at_eof:
+                return
+            else:
+                time.sleep(interval)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def follow(args):
+    """The `follow` subcommand"""
+    try:
+        if not args.filepath or len(args.filepath) != 1:
+            raise cli.CliError('follow requires a single filepath')
+        filepath = args.filepath[0]
+        pattern_arg = args.pattern
+        if pattern_arg == 'auto':
+            with cli.read_input(filepath, False) as lines:
+                pattern_arg = detect_pattern(lines)[0]
     except cli.CliError as e:
-        raise argparse.ArgumentError(args.filepath, str(e))
+        raise argparse.ArgumentError(None, str(e))
+    pattern = get_pattern(pattern_arg)
+    stats = get_stats(args)
+    position = None
+    if args.checkpoint is not None:
+        position = load_checkpoint(args.checkpoint)
+    batches = tail_lines(filepath, position, interval=args.interval,
+                         exit_at_eof=args.exit_at_eof)
+    try:
+        for lines, position in batches:
+            logs = parse_lines(lines, pattern, stats=stats)
+            write_ndjson(itertools.imap(json.dumps, logs), sys.stdout)
+            sys.stdout.flush()
+            if args.checkpoint is not None:
+                save_checkpoint(args.checkpoint, position)
+    finally:
+        report_stats(args, stats)
 
 
 def list_patterns(args):
@@ -100,24 +736,177 @@ def list_patterns(args):
         print
 
 
+def test():
+    """Tests (Use nosetests to run them)"""
+    for value in ['08/Nov/2012:13:15:05 +0000',
+                  '08/Nov/2012:13:15:05 +0530',
+                  '31/Dec/2012:23:59:59 -0800',
+                  '08/Nov/2012:13:15:05 +0000']:
+        expected = datetime_to_timestamp(dateparser.parse(value, fuzzy=True))
+        assert apache_timestamp(value) == expected
+        assert parse_timestamp(value) == expected
+    assert apache_timestamp('2012-11-08 13:15:05 +0000') is None
+    assert apache_timestamp('08/Nov/2012:13:15:05 UTC') is None
+    assert parse_timestamp('2012-11-08T13:15:05+00:00') == 1352380505.0
+
+    apache = ('183.82.25.178 - - [08/Nov/2012:13:15:05 +0000] '
+              '"GET /favicon.ico HTTP/1.1" 404 503 "-" "Firefox/16.0"')
+    nginx = ('10.0.0.1 - bob [08/Nov/2012:13:15:05 +0000] '
+             '"DELETE /items/1 HTTP/1.1" 204 0 "-" "curl/7.29.0"')
+    assert LOG_PATTERNS['apache2_access'].match(apache) is not None
+    assert LOG_PATTERNS['apache2_access'].match('junk') is None
+    assert LOG_PATTERNS['apache2_access'].match('') is None
+    assert LOG_PATTERNS['apache2_access'].match(nginx) is None
+    assert LOG_PATTERNS['nginx_access'].match(nginx) is not None
+    tabbed = apache.replace(' - - [', '\t-\t-\t[').replace('] "', ']\t"')
+    assert LOG_PATTERNS['apache2_access'].match(tabbed) is not None
+    assert LOG_PATTERNS['nginx_access'].match(
+        nginx.replace('] "', ']\t"')) is not None
+    name, lines = detect_pattern(['junk', '', apache, apache])
+    assert name == 'apache2_access'
+    assert list(lines) == ['junk', '', apache, apache]
+    assert sorted(DETECT_ORDER) == sorted(LOG_PATTERNS)
+    assert LOG_PATTERNS['nginx_access'].match(apache) is not None
+    name, lines = detect_pattern([nginx, apache, nginx], sample_size=2)
+    assert name == 'nginx_access'
+    assert list(lines) == [nginx, apache, nginx]
+
+    record = parse_line(apache, LOG_PATTERNS['apache2_access'], compact=True)
+    log = parse_line(apache, LOG_PATTERNS['apache2_access'])
+    assert record['path'] == log['path'] == '/favicon.ico'
+    assert record.status_code == 404 and record['content_size'] == 503
+    assert record['timestamp'] == log['timestamp']
+    assert record == LogRecord.from_dict(json.loads(json.dumps(log)))
+    assert record.get('datetime') is None
+    assert not hasattr(record, '__dict__')
+
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        logfile = os.path.join(tmpdir, 'access.log')
+        with open(logfile, 'w') as f:
+            f.write('a\nb\nc')
+        batches = list(tail_lines(logfile, exit_at_eof=True))
+        assert [l for lines, _ in batches for l in lines] == ['a\n', 'b\n', 'c']
+        assert batches[-1][1] == (os.stat(logfile).st_ino, 5)
+
+        checkpoint = os.path.join(tmpdir, 'checkpoint')
+        assert load_checkpoint(checkpoint) is None
+        with open(logfile, 'w') as f:
+            f.write('1\n2\n')
+        (lines, position), = tail_lines(logfile, exit_at_eof=True)
+        save_checkpoint(checkpoint, position)
+        assert load_checkpoint(checkpoint) == position
+        assert not os.path.exists(checkpoint + '.tmp')
+
+        # resumes after the lines already read
+        with open(logfile, 'a') as f:
+            f.write('3\n')
+        batches = list(tail_lines(logfile, load_checkpoint(checkpoint),
+                                  exit_at_eof=True))
+        assert batches == [(['3\n'], (position[0], 6))]
+        position = batches[-1][1]
+
+        # rotated: the rest of the old file, then the new one
+        os.rename(logfile, logfile + '.1')
+        with open(logfile + '.1', 'a') as f:
+            f.write('4\n')
+        with open(logfile, 'w') as f:
+            f.write('5\n')
+        lines = [l for ls, _ in tail_lines(logfile, position,
+                                           exit_at_eof=True) for l in ls]
+        assert lines == ['4\n', '5\n']
+
+        # truncated in place: read again from the start
+        position = (os.stat(logfile).st_ino, 100)
+        lines = [l for ls, _ in tail_lines(logfile, position,
+                                           exit_at_eof=True) for l in ls]
+        assert lines == ['5\n']
+        with open(logfile, 'w') as f:
+            f.write('6\n')
+        batches = tail_lines(logfile, exit_at_eof=True, batch_size=1)
+        assert next(batches) == (['6\n'], (os.stat(logfile).st_ino, 2))
+        with open(logfile, 'r+') as f:
+            f.truncate(0)
+        with open(logfile, 'a') as f:
+            f.write('7')
+        assert [l for ls, _ in batches for l in ls] == ['7']
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('subcommand', help='subcommand ( convert | list_patterns )',
+    parser.add_argument('subcommand',
+                        help='subcommand ( convert | follow | list_patterns )',
                         nargs='?', default='convert')
-    parser.add_argument('-f', '--filepath',
-                        help='path to the log file')
+    parser.add_argument('-f', '--filepath', nargs='+',
+                        help=(
+                            'path to the log file, multiple paths and '
+                            'glob patterns are read one after the other '
+                            'and gzip, bz2 and xz files are decompressed'
+                        ))
     parser.add_argument('-i', '--stdin',
                         help='Use standard input', action='store_true')
     parser.add_argument('-p', '--pattern',
                         help=(
                             'Regex pattern or name of a '
-                            'predefined pattern for parsing logs'
+                            'predefined pattern for parsing logs, or '
+                            '"auto" to detect the predefined pattern '
+                            'from the first lines'
                         ), default='apache2_access')
+    parser.add_argument('-o', '--output-format',
+                        help=(
+                            'Output format, a json array, newline '
+                            'delimited json (one log per line) or the '
+                            'compact columnar binary format'
+                        ), default='json',
+                        choices=sorted(OUTPUT_WRITERS.keys()) + ['columnar'])
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help=(
+                            'Number of processes to use for converting '
+                            'the file in parallel'
+                        ))
+    parser.add_argument('--unordered',
+                        help=(
+                            'Do not preserve the order of the logs in '
+                            'parallel mode'
+                        ), action='store_true')
+    parser.add_argument('-c', '--checkpoint',
+                        help=(
+                            'File to save the position in the log file '
+                            'to, for resuming the follow subcommand'
+                        ))
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help=(
+                            'Seconds to wait before checking for new '
+                            'lines in the follow subcommand'
+                        ))
+    parser.add_argument('--exit-at-eof',
+                        help=(
+                            'Exit at the end of the file instead of '
+                            'waiting for more lines in the follow '
+                            'subcommand'
+                        ), action='store_true')
+    parser.add_argument('--stats',
+                        help=(
+                            'Print the lines read, matched and rejected '
+                            'and the time spent per stage to stderr'
+                        ), action='store_true')
+    parser.add_argument('--stats-file',
+                        help=(
+                            'File to write the stats to as json, along '
+                            'with a sample of the rejected lines'
+                        ))
     args = parser.parse_args()
 
     if args.subcommand == 'convert':
         convert(args)
 
+    if args.subcommand == 'follow':
+        follow(args)
+
     if args.subcommand == 'list_patterns':
         list_patterns(args)
 
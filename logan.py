@@ -1,25 +1,114 @@
 """Analyse the urls in log files
 
-Usage: logan.py ( -i | FILE ) [ -p PATTERN_FILE ]
+The rollup command writes the analysis per minute or per hour as a
+partial, which can be merged with the partials of other log files
+(eg. of other web servers) by the merge command. The merged analysis
+is the same as that of a single run over all the log files.
+
+The store command adds the daily analysis of log files to a sqlite
+database, from which the report command prints the analysis of any
+range of days without reading the logs again. Files that were
+already stored are skipped, and only the new lines of those that
+grew since are read (except for compressed, json and columnar files).
+
+Usage: logan.py rollup ( -i | FILE... ) -o OUTPUT_FILE [ -p PATTERN_FILE ]
+                 [ -f FORMAT ] [ -l LOG_PATTERN ] [ --compact ] [ -b BUCKET ]
+                 [ --cache-size=N ]
+       logan.py merge PARTIAL... [ -o OUTPUT_FILE ] [ -b BUCKET ]
+       logan.py store DB FILE... [ -p PATTERN_FILE ] [ -f FORMAT ]
+                 [ -l LOG_PATTERN ] [ --compact ] [ --cache-size=N ]
+       logan.py report DB [ --from=DATE ] [ --to=DATE ] [ -o OUTPUT_FILE ]
+       logan.py ( -i | FILE... ) [ -p PATTERN_FILE ] [ -f FORMAT ]
+                 [ -l LOG_PATTERN ] [ --compact ]
+                 [ --stats | --top-k=K [ --max-keys=N ] ] [ -o OUTPUT_FILE ]
+                 [ --cache-size=N ]
        logan.py ( -h | --help | --version )
 
 Options:
   -h --help
   -i --stdin
   -p PATTERN_FILE --pattern_file=PATTERN_FILE
+  -f FORMAT --format=FORMAT  Input format, json (array), ndjson, raw
+                             (log file) or columnar [default: json]
+  -l LOG_PATTERN --log_pattern=LOG_PATTERN  log2json pattern name,
+                             regex or auto for raw input
+                             [default: apache2_access]
+  --compact  Keep the logs in memory as compact records instead of dicts
+  --stats  Also report the status codes and the percentiles of the
+           response sizes of each url pattern
+  --top-k=K  Only report the K most hit url patterns, counted
+             approximately in bounded memory
+  --max-keys=N  Number of url patterns --top-k keeps count of. The
+                higher, the more accurate [default: 10000]
+  --cache-size=N  Number of paths whose url pattern is cached, 0 to
+                  disable the cache [default: 10000]
+  -o OUTPUT_FILE --output=OUTPUT_FILE  Also write the analysis as json.
+                             The partial written by rollup and merge
+  --from=DATE  First day (UTC) of the report, as YYYY-MM-DD
+  --to=DATE  Last day (UTC) of the report, as YYYY-MM-DD
+  -b BUCKET --bucket=BUCKET  Time bucket of the partials, minute or
+                             hour. rollup defaults to minute and merge
+                             to that of the partials
 
 """
 
 ## Important: This script uses docopt for argument parsing and hence
 ## is __doc__ sensitive!
 
+import os
 import re
+import sys
 import json
+import hashlib
+import sqlite3
+from datetime import datetime
 from collections import Counter
 from urlparse import urlparse
 from docopt import docopt
 
 import cli
+import log2json
+import logcolumns
+from sketches import QuantileSketch, SpaceSaving
+
+
+# Fields of the logs that are used, the only columns read from
+# columnar input
+COLUMNS = ['method', 'path']
+
+# Fields needed for --stats
+STATS_COLUMNS = COLUMNS + ['status_code', 'content_size']
+
+# Fields needed for rollups
+ROLLUP_COLUMNS = STATS_COLUMNS + ['timestamp']
+
+# Percentiles of the response sizes that are reported
+PERCENTILES = (50, 90, 99)
+
+# Width of the time buckets of rollups, in seconds
+BUCKETS = {'minute': 60, 'hour': 3600}
+
+ROLLUP_VERSION = 1
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS aggregates (
+    day TEXT, source TEXT, method TEXT, path TEXT, hits INTEGER, stats TEXT,
+    PRIMARY KEY (day, source, method, path)
+);
+CREATE TABLE IF NOT EXISTS processed_files (
+    inode INTEGER PRIMARY KEY, head TEXT, path TEXT, size INTEGER,
+    mtime REAL, offset INTEGER
+);
+"""
+
+DAY = 86400
+
+# number of leading bytes hashed to tell a file from another one that
+# got the same inode
+HEAD_SIZE = 4096
+
+DAY_FORMAT = '%Y-%m-%d'
 
 
 def path_pattern(path, pattern):
@@ -40,37 +129,748 @@ def path_pattern(path, pattern):
     return path
 
 
-def dynamic_urls(logs, patterns=None):
+# Max number of groups in a single combined regex. Python 2's re
+# module doesn't support more than 100
+MAX_GROUPS = 99
+
+GROUP_NAME_RE = re.compile(r'\(\?P<(\w+)>')
+GROUP_REF_RE = re.compile(r'\(\?P=(\w+)\)')
+# backreferences by number and conditional groups, which aren't renamed
+NUMBERED_REF_RE = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\()')
+
+
+class URLMatcher(object):
+    """Finds the pattern of a path among many url patterns in a single
+    regex match
+
+    The patterns are combined into an alternation, with each pattern
+    wrapped in a group of its own so that the matching one can be
+    told from `lastgroup`, and its named groups renamed so that they
+    don't clash with those of the other patterns. As with the Django
+    urlconf, the first pattern that matches wins. Since the number of
+    groups in a regex is limited, the alternation is split into as
+    few chunks as needed, which are tried in order.
+
+    As the same paths keep coming back in logs, the url patterns of
+    the recently seen paths are cached, in two generations of at most
+    `cache_size` / 2 paths. When the current one is full it replaces
+    the older one, whose paths move back to the current one if seen
+    again. This is close to an LRU cache, without the cost of keeping
+    the paths in order on every hit.
+
+    :param patterns: list of str
+    :param cache_size: int, 0 to disable the cache
+
+    """
+
+    def __init__(self, patterns, cache_size=10000):
+        self.has_patterns = len(patterns) > 0
+        self.cache_size = cache_size
+        self.cache = {}
+        self.old_cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.chunks = []
+        alternatives, groups, ngroups = [], {}, 0
+        for i, pattern in enumerate(patterns):
+            compiled = re.compile(pattern)
+            if (compiled.flags or compiled.groups + 1 > MAX_GROUPS or
+                    NUMBERED_REF_RE.search(pattern)):
+                # inline flags would apply to the whole alternation,
+                # and group numbers would be shifted by the others
+                self._add_chunk(alternatives, groups)
+                alternatives, groups, ngroups = [], {}, 0
+                self.chunks.append((compiled, None))
+                continue
+            if ngroups + compiled.groups + 1 > MAX_GROUPS:
+                self._add_chunk(alternatives, groups)
+                alternatives, groups, ngroups = [], {}, 0
+            prefix = '_p%d_' % (i,)
+            renamed = GROUP_NAME_RE.sub(r'(?P<%s\1>' % (prefix,), pattern)
+            renamed = GROUP_REF_RE.sub(r'(?P=%s\1)' % (prefix,), renamed)
+            outer = '_p%d' % (i,)
+            alternatives.append('(?P<%s>%s)' % (outer, renamed))
+            groups[outer] = [(prefix + name, name)
+                             for name in sorted(compiled.groupindex,
+                                                key=compiled.groupindex.get)]
+            ngroups += compiled.groups + 1
+        self._add_chunk(alternatives, groups)
+
+    def _add_chunk(self, alternatives, groups):
+        if alternatives:
+            self.chunks.append((re.compile('|'.join(alternatives)), groups))
+
+    def normalize(self, path):
+        """Finds the pattern of the path, same as `path_pattern` does
+        for a single pattern
+
+        :param path: str
+        :rtype: str
+
+        """
+        if not self.has_patterns:
+            return path
+        if not self.cache_size:
+            return self._normalize(path)
+        # the query string is stripped anyway, so the paths that only
+        # differ by it share the entry
+        key = path.split('?', 1)[0]
+        try:
+            result = self.cache[key]
+            self.hits += 1
+            return result
+        except KeyError:
+            pass
+        try:
+            result = self.old_cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            result = self._normalize(key)
+            self.misses += 1
+        if len(self.cache) >= max(1, self.cache_size // 2):
+            self.old_cache = self.cache
+            self.cache = {}
+        self.cache[key] = result
+        return result
+
+    def cache_info(self):
+        """Hit rate of the cache as a line"""
+        lookups = self.hits + self.misses
+        return ('Path cache: %d lookups, %.1f%% hits, %d paths cached' %
+                (lookups, 100.0 * self.hits / lookups if lookups else 0,
+                 len(self.cache) + len(self.old_cache)))
+
+    def _normalize(self, path):
+        path = urlparse(path).path
+        for regex, groups in self.chunks:
+            match = regex.match(path)
+            if match is None:
+                continue
+            if groups is None:
+                names = [(k, k) for k in sorted(regex.groupindex,
+                                                key=regex.groupindex.get)]
+            else:
+                names = groups[match.lastgroup]
+            for group, name in names:
+                value = match.group(group)
+                if value is not None:
+                    path = path.replace(value, '<%s>' % (name,))
+            return path
+        return path
+
+
+def dynamic_urls(logs, patterns=None, matcher=None):
     """Extract dynamic urls from the logs using the urlconf and print them
 
-    :param logs: list of dicts
+    :param logs: iterable of dicts or log2json.LogRecords
     :param patterns: list of strings [default: None]
+    :param matcher: URLMatcher, to use instead of one for patterns
     :rtype: collections.Counter
 
     """
-    patterns = [] if patterns is None else map(re.compile, patterns)
-    paths = []
+    if matcher is None:
+        matcher = URLMatcher(patterns or [])
+    url_counts = Counter()
+    for log in logs:
+        url_counts[(log['method'], matcher.normalize(log['path']))] += 1
+    return url_counts
+
+
+def top_urls(logs, patterns=None, capacity=10000, matcher=None):
+    """Same as `dynamic_urls` but only keeps count of `capacity` url
+    patterns, the most hit ones, so that memory use is bounded even if
+    the patterns don't cover all the paths
+
+    :param logs: iterable of dicts or log2json.LogRecords
+    :param patterns: list of strings [default: None]
+    :param capacity: int, number of url patterns kept
+    :param matcher: URLMatcher, to use instead of one for patterns
+    :rtype: sketches.SpaceSaving
+
+    """
+    if matcher is None:
+        matcher = URLMatcher(patterns or [])
+    top = SpaceSaving(capacity)
     for log in logs:
-        path = log['path']
-        for p in patterns:
-            path = path_pattern(path, p)
-        paths.append((log['method'], path))
-    return Counter(paths)
+        top.add((log['method'], matcher.normalize(log['path'])))
+    return top
+
+
+class EndpointStats(object):
+    """Hits, status codes and response sizes of a url pattern
+
+    Memory use is bounded whatever the number of hits, and stats of
+    different parts of the logs can be merged.
+
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.statuses = Counter()
+        self.sizes = QuantileSketch()
+
+    def add(self, log):
+        self.hits += 1
+        status = log.get('status_code')
+        if status is not None:
+            self.statuses[int(status)] += 1
+        size = log.get('content_size')
+        if size is not None:
+            self.sizes.add(int(size))
 
+    def merge(self, other):
+        self.hits += other.hits
+        self.statuses.update(other.statuses)
+        self.sizes.merge(other.sizes)
 
-def print_to_stdout(url_counts):
+    def percentiles(self):
+        """Estimated percentiles of the response sizes
+
+        :rtype: dict of percentile -> size in bytes (None if unknown)
+
+        """
+        return dict((p, self.sizes.quantile(p / 100.0)) for p in PERCENTILES)
+
+    def to_dict(self):
+        return {
+            'hits': self.hits,
+            'statuses': dict((str(k), v) for k, v in self.statuses.iteritems()),
+            'sizes': self.sizes.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.hits = data['hits']
+        stats.statuses = Counter(dict((int(k), v) for k, v
+                                      in data['statuses'].iteritems()))
+        stats.sizes = QuantileSketch.from_dict(data['sizes'])
+        return stats
+
+
+def url_stats(logs, patterns=None, matcher=None):
+    """Same as `dynamic_urls` but collects EndpointStats for each url
+    pattern instead of only counting the hits
+
+    :param logs: iterable of dicts or log2json.LogRecords
+    :param patterns: list of strings [default: None]
+    :param matcher: URLMatcher, to use instead of one for patterns
+    :rtype: dict of (method, url pattern) -> EndpointStats
+
+    """
+    if matcher is None:
+        matcher = URLMatcher(patterns or [])
+    stats = {}
+    for log in logs:
+        key = (log['method'], matcher.normalize(log['path']))
+        try:
+            stats[key].add(log)
+        except KeyError:
+            endpoint = stats[key] = EndpointStats()
+            endpoint.add(log)
+    return stats
+
+
+def rollup(logs, patterns=None, bucket=60, matcher=None):
+    """Collects EndpointStats for each url pattern and time bucket
+
+    :param logs: iterable of dicts or log2json.LogRecords
+    :param patterns: list of strings [default: None]
+    :param bucket: int, width of the time buckets in seconds
+    :param matcher: URLMatcher, to use instead of one for patterns
+    :rtype: dict of (bucket start, method, url pattern) -> EndpointStats.
+            The bucket start is None for logs without a timestamp
+
+    """
+    if matcher is None:
+        matcher = URLMatcher(patterns or [])
+    rollups = {}
+    for log in logs:
+        timestamp = log.get('timestamp')
+        if timestamp is not None:
+            timestamp = int(timestamp // bucket) * bucket
+        key = (timestamp, log['method'], matcher.normalize(log['path']))
+        try:
+            rollups[key].add(log)
+        except KeyError:
+            endpoint = rollups[key] = EndpointStats()
+            endpoint.add(log)
+    return rollups
+
+
+def merge_rollups(rollups, other, bucket=None):
+    """Merges the rollups `other` into `rollups`, in place
+
+    :param rollups: dict, as returned by `rollup`
+    :param other: dict, as returned by `rollup`
+    :param bucket: int, to also move the rollups to wider time buckets
+                   [default: None]
+    :rtype: dict, rollups
+
+    """
+    for (timestamp, method, path), stats in other.iteritems():
+        if bucket is not None and timestamp is not None:
+            timestamp = timestamp // bucket * bucket
+        key = (timestamp, method, path)
+        if key not in rollups:
+            rollups[key] = EndpointStats()
+        rollups[key].merge(stats)
+    return rollups
+
+
+def rollup_totals(rollups):
+    """Stats of each url pattern over all the time buckets
+
+    :param rollups: dict, as returned by `rollup`
+    :rtype: dict of (method, url pattern) -> EndpointStats
+
+    """
+    totals = {}
+    for (_, method, path), stats in rollups.iteritems():
+        if (method, path) not in totals:
+            totals[(method, path)] = EndpointStats()
+        totals[(method, path)].merge(stats)
+    return totals
+
+
+def dump_rollup(rollups, bucket, out):
+    """Writes rollups as a json partial
+
+    :param rollups: dict, as returned by `rollup`
+    :param bucket: int, width of the time buckets in seconds
+    :param out: file like object
+    :rtype: None
+
+    """
+    json.dump({
+        'version': ROLLUP_VERSION,
+        'bucket': bucket,
+        'rollups': [{'time': timestamp, 'method': method, 'path': path,
+                     'stats': rollups[(timestamp, method, path)].to_dict()}
+                    for timestamp, method, path in sorted(rollups)],
+    }, out, separators=(',', ':'))
+
+
+def load_rollup(f):
+    """Reads a partial written by `dump_rollup`
+
+    :param f: file like object
+    :rtype: tuple of (bucket, rollups)
+
+    """
+    data = json.load(f)
+    if data.get('version') != ROLLUP_VERSION:
+        raise cli.CliError('Not a logan partial or unsupported version')
+    rollups = {}
+    for item in data['rollups']:
+        key = (item['time'], item['method'], item['path'])
+        rollups[key] = EndpointStats.from_dict(item['stats'])
+    return data['bucket'], rollups
+
+
+def merge_partials(filepaths, bucket=None):
+    """Merges the partials in files
+
+    :param filepaths: list of str
+    :param bucket: int, width of the time buckets of the result, the
+                   widest of the partials' if None [default: None]
+    :rtype: tuple of (bucket, rollups)
+
+    """
+    partials = []
+    for filepath in cli.expand_paths(filepaths):
+        with open(filepath) as f:
+            partials.append(load_rollup(f))
+    widths = [width for width, _ in partials]
+    if bucket is None:
+        bucket = max(widths)
+    if any(bucket % width for width in widths):
+        raise cli.CliError('Partials with %ss buckets can\'t be merged into '
+                           '%ss buckets' % (max(widths), bucket))
+    merged = {}
+    for width, rollups in partials:
+        merge_rollups(merged, rollups, bucket if bucket != width else None)
+    return bucket, merged
+
+
+class AggregateStore(object):
+    """Daily stats of each url pattern stored in a sqlite database,
+    along with the files they come from
+
+    The stats are kept per day and source, the log a file holds as
+    told by `log_source`, so the files can be added in any order, and
+    a log added again under another name or once compressed replaces
+    its stats instead of being counted twice. As the url patterns are
+    part of the keys, all the files have to be added with the same
+    patterns.
+
+    :param filepath: str, path of the database
+    :param patterns: list of str, the url patterns, only checked
+                     against the stored ones if not None
+
+    """
+
+    def __init__(self, filepath, patterns=None):
+        self.conn = sqlite3.connect(filepath)
+        self.conn.executescript(STORE_SCHEMA)
+        if patterns is not None:
+            self._check_patterns(patterns)
+
+    def _check_patterns(self, patterns):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'patterns'").fetchone()
+        if row is None:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO meta VALUES ('patterns', ?)",
+                    (json.dumps(patterns),))
+        elif json.loads(row[0]) != patterns:
+            raise cli.CliError('The store was built with other url patterns')
+
+    def file_state(self, filepath, st=None):
+        """Size, mtime and offset up to which the file was processed
+
+        Files are recognized by their inode and the hash of their
+        leading bytes rather than by their path, so that a log renamed
+        by logrotate isn't added again under its new name, and that a
+        new file at the path of an old one is read from the start.
+
+        :param filepath: str
+        :param st: result of os.stat for the file, if already known
+        :rtype: tuple or None if the file was never added
+
+        """
+        st = st or os.stat(filepath)
+        row = self.conn.execute(
+            'SELECT head, size, mtime, offset FROM processed_files '
+            'WHERE inode = ?', (st.st_ino,)).fetchone()
+        if row is None or st.st_size < row[3]:
+            return None
+        if file_head(filepath, min(row[1], HEAD_SIZE)) != row[0]:
+            return None
+        return row[1:]
+
+    def add(self, rollups, filepath, size, mtime, offset, inode, source,
+            replace=False):
+        """Adds daily rollups of a file to the stats of its source, and
+        records that the file was processed, in a single transaction
+
+        :param rollups: dict, as returned by `rollup` with daily buckets
+        :param filepath: str
+        :param size: int, size of the file
+        :param mtime: float, modification time of the file
+        :param offset: int, position up to which the file was read
+        :param inode: int, inode of the file
+        :param source: str, as returned by `log_source`
+        :param replace: bool, whether the rollups cover the whole
+                        source, and replace its stored stats of the
+                        same days instead of being merged into them
+        :rtype: None
+
+        """
+        head = file_head(filepath, min(size, HEAD_SIZE))
+        days = {}
+        for (timestamp, method, path), stats in rollups.iteritems():
+            if timestamp is not None:
+                day = datetime.utcfromtimestamp(timestamp).strftime(DAY_FORMAT)
+                days.setdefault(day, []).append((method, path, stats))
+        with self.conn:
+            for day, day_rollups in sorted(days.iteritems()):
+                if replace:
+                    self.conn.execute(
+                        'DELETE FROM aggregates WHERE day = ? AND source = ?',
+                        (day, source))
+                for method, path, stats in day_rollups:
+                    row = None if replace else self.conn.execute(
+                        'SELECT stats FROM aggregates WHERE day = ? AND '
+                        'source = ? AND method = ? AND path = ?',
+                        (day, source, method, path)).fetchone()
+                    if row is not None:
+                        stored = EndpointStats.from_dict(json.loads(row[0]))
+                        stored.merge(stats)
+                        stats = stored
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO aggregates '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (day, source, method, path, stats.hits,
+                         json.dumps(stats.to_dict(), separators=(',', ':'))))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO processed_files '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (inode, head, os.path.abspath(filepath), size, mtime, offset))
+
+    def query(self, start=None, end=None):
+        """Stats of each url pattern over a range of days
+
+        :param start: str, first day as YYYY-MM-DD, the first stored if
+                      None
+        :param end: str, last day as YYYY-MM-DD, the last stored if None
+        :rtype: dict of (method, url pattern) -> EndpointStats
+
+        """
+        totals = {}
+        rows = self.conn.execute(
+            'SELECT method, path, stats FROM aggregates '
+            'WHERE day >= ? AND day <= ?',
+            (start or '0000-00-00', end or '9999-99-99'))
+        for method, path, stats in rows:
+            stats = EndpointStats.from_dict(json.loads(stats))
+            if (method, path) in totals:
+                totals[(method, path)].merge(stats)
+            else:
+                totals[(method, path)] = stats
+        return totals
+
+    def close(self):
+        self.conn.close()
+
+
+def file_head(filepath, size):
+    """Hash of the first bytes of a file
+
+    :param filepath: str
+    :param size: int, number of bytes hashed
+    :rtype: str
+
+    """
+    with open(filepath, 'rb') as f:
+        return hashlib.sha1(f.read(size)).hexdigest()
+
+
+def log_source(filepath, input_format='json'):
+    """Identifier of the log a file holds, the hash of its first line
+    (of its first bytes for json), decompressed. It stays the same
+    when logrotate renames or compresses the file, or when the log
+    grows
+
+    :param filepath: str
+    :param input_format: str, as for `read_logs`
+    :rtype: str
+
+    """
+    f = cli.open_input(filepath)
+    try:
+        if input_format == 'json':
+            head = f.read(HEAD_SIZE)
+        else:
+            head = f.readline()
+            if not head.endswith('\n'):
+                head = ''
+    finally:
+        f.close()
+    return hashlib.sha1(head).hexdigest()
+
+
+def complete_lines(f, position):
+    """Generator of the lines of f up to the last one ending with a
+    newline, the one after may still be being written
+
+    :param f: file like object
+    :param position: list with the offset where f was read from as
+                     only element, moved past every yielded line
+    :rtype: generator of str
+
+    """
+    for line in f:
+        if not line.endswith('\n'):
+            return
+        position[0] += len(line)
+        yield line
+
+
+def store_file(store, filepath, input_format='json',
+               log_pattern='apache2_access', compact=False, matcher=None):
+    """Adds the daily stats of the logs in a file to the store, unless
+    it was already added. If it grew since, only the new lines are
+    read when possible, else it's skipped. A file that got smaller or
+    was replaced by another one is added as a new file. The stats of a
+    file read as a whole replace those stored for its source, so a log
+    added again under another name isn't counted twice
+
+    :param store: AggregateStore
+    :param filepath: str
+    :param input_format: str, as for `read_logs`
+    :param log_pattern: str, as for `read_logs`
+    :param compact: bool, as for `read_logs`
+    :param matcher: URLMatcher
+    :rtype: str, what was done with the file
+
+    """
+    st = os.stat(filepath)
+    state = store.file_state(filepath, st)
+    if state is not None and state[:2] == (st.st_size, st.st_mtime):
+        return 'unchanged'
+    streamable = (input_format in ('ndjson', 'raw') and
+                  cli.compression(filepath) is None)
+    if streamable:
+        offset = 0 if state is None else state[2]
+        position = [offset]
+        with open(filepath, 'rb') as f:
+            f.seek(offset)
+            logs = iter_logs(complete_lines(f, position), input_format,
+                             log_pattern, compact)
+            rollups = rollup(logs, bucket=DAY, matcher=matcher)
+        store.add(rollups, filepath, st.st_size, st.st_mtime, position[0],
+                  st.st_ino, log_source(filepath, input_format), offset == 0)
+        return 'added' if state is None else 'added new lines'
+    if state is not None:
+        return 'skipped, changed since stored'
+    logs = read_logs([filepath], False, input_format, log_pattern, compact,
+                     ROLLUP_COLUMNS)
+    rollups = rollup(logs, bucket=DAY, matcher=matcher)
+    store.add(rollups, filepath, st.st_size, st.st_mtime, st.st_size,
+              st.st_ino, log_source(filepath, input_format), True)
+    return 'added'
+
+
+def read_logs(filepaths, stdin, input_format='json',
+              log_pattern='apache2_access', compact=False, columns=COLUMNS):
+    """Generator of the logs in the input files or stdin
+
+    Except for json, which has to be loaded one file at a time, the
+    logs are read as a stream so memory use doesn't depend on the size
+    of the input. raw input is parsed with the log2json patterns.
+
+    :param filepaths: list of str
+    :param stdin: bool
+    :param input_format: str, one of `json`, `ndjson`, `raw` or
+                         `columnar`
+    :param log_pattern: str, log2json pattern name, regex or `auto`
+    :param compact: bool, yield log2json.LogRecords instead of dicts
+    :param columns: list of str, the fields read from columnar input
+    :rtype: generator of dicts or log2json.LogRecords
+
+    """
+    if input_format in ('json', 'columnar'):
+        for filepath in cli.expand_paths(filepaths) if filepaths else [None]:
+            with cli.read_input(filepath, stdin) as f:
+                if input_format == 'columnar':
+                    logs = logcolumns.iter_records(f, columns)
+                elif compact:
+                    logs = json.load(f,
+                                     object_hook=log2json.LogRecord.from_dict)
+                else:
+                    logs = json.load(f)
+                for log in logs:
+                    yield log
+        return
+    with cli.read_input(filepaths, stdin) as f:
+        for log in iter_logs(f, input_format, log_pattern, compact):
+            yield log
+
+
+def iter_logs(lines, input_format='ndjson', log_pattern='apache2_access',
+              compact=False):
+    """Generator of the logs in lines of ndjson or raw input
+
+    :param lines: iterable of str
+    :param input_format: str, `ndjson` or `raw`
+    :param log_pattern: str, log2json pattern name, regex or `auto`
+    :param compact: bool, yield log2json.LogRecords instead of dicts
+    :rtype: generator of dicts or log2json.LogRecords
+
+    """
+    if input_format == 'ndjson':
+        for line in lines:
+            if line.strip() == '':
+                continue
+            log = json.loads(line)
+            yield log2json.LogRecord.from_dict(log) if compact else log
+    elif input_format == 'raw':
+        if log_pattern == 'auto':
+            log_pattern, lines = log2json.detect_pattern(lines)
+        pattern = log2json.get_pattern(log_pattern)
+        for log in log2json.parse_lines(lines, pattern, compact):
+            yield log
+    else:
+        raise cli.CliError('Unknown input format: %s' % (input_format,))
+
+
+def format_stats(stats):
+    """Status codes and size percentiles of an url pattern as a line
+
+    :param stats: EndpointStats
+    :rtype: str
+
+    """
+    sizes = stats.percentiles()
+    sizes = ' '.join('p%d=%s' % (p, '-' if sizes[p] is None
+                                  else int(round(sizes[p])))
+                     for p in PERCENTILES)
+    statuses = ' '.join('%d=%d' % (k, v)
+                        for k, v in sorted(stats.statuses.iteritems()))
+    return 'bytes %s  status %s' % (sizes, statuses)
+
+
+def print_to_stdout(url_counts, stats=None):
     """Prints the url anaylsis to stdout
 
     :param url_counts: collections.Counter
+    :param stats: dict of url pattern -> EndpointStats [default: None]
     :rtype: None
 
     """
     print 'Total hits: %d' % (sum(url_counts.values()),)
     print '====' * 20
-    sortedkeys = sorted(url_counts, key=lambda x: url_counts[x],
-                        reverse=True)
+    sortedkeys = sorted(url_counts, key=lambda x: (-url_counts[x], x))
     for k in sortedkeys:
         print('[%s] - %s: %d' % (k[0], k[1], url_counts[k]))
+        if stats is not None:
+            print('    %s' % (format_stats(stats[k]),))
+
+
+def print_top(top, k):
+    """Prints the approximate top k url patterns to stdout
+
+    :param top: sketches.SpaceSaving
+    :param k: int
+    :rtype: None
+
+    """
+    print 'Total hits: %d' % (top.total,)
+    print ('Approximate top %d: counts are at most "error" higher than the '
+           'actual ones, %d surely in the top %d' %
+           (k, top.guaranteed(k), k))
+    print '====' * 20
+    for (method, path), count, error in top.top(k):
+        print('[%s] - %s: %d (error %d)' % (method, path, count, error))
+
+
+def top_as_json(top, k):
+    """The approximate top k url patterns as a json serializable list
+
+    :param top: sketches.SpaceSaving
+    :param k: int
+    :rtype: list of dicts
+
+    """
+    return [{'method': method, 'path': path, 'hits': count, 'error': error}
+            for (method, path), count, error in top.top(k)]
+
+
+def as_json(url_counts, stats=None):
+    """The url analysis as a json serializable list, most hit first
+
+    :param url_counts: collections.Counter
+    :param stats: dict of url pattern -> EndpointStats [default: None]
+    :rtype: list of dicts
+
+    """
+    result = []
+    for method, path in sorted(url_counts,
+                               key=lambda x: (-url_counts[x], x)):
+        hits = url_counts[(method, path)]
+        item = {'method': method, 'path': path, 'hits': hits}
+        if stats is not None:
+            endpoint = stats[(method, path)]
+            item['statuses'] = dict((str(k), v) for k, v
+                                    in endpoint.statuses.iteritems())
+            item['sizes'] = dict(('p%d' % (p,), v) for p, v
+                                 in endpoint.percentiles().iteritems())
+            item['sizes']['mean'] = endpoint.sizes.mean()
+            item['sizes']['max'] = endpoint.sizes.max
+        result.append(item)
+    return result
 
 
 def test():
@@ -79,6 +879,161 @@ def test():
     assert path_pattern(u1, p1) == '/feedapi/<appid>/products/'
     assert path_pattern('/shopper/widget-init/', p1) == '/shopper/widget-init/'
 
+    patterns = ['/feedapi/(?P<appid>\\w+)/products/',
+                '/(?P<id>\\d+)/(?P=id)/',
+                '(?i)/shop/(?P<id>\\d+)/',
+                '/b/(\\d+)/\\1/(?P<id>\\d+)/']
+    patterns += ['/items%d/(?P<id>\\d+)/' % (i,) for i in range(150)]
+    m = URLMatcher(patterns)
+    assert len(m.chunks) > 2
+    assert m.normalize(u1) == '/feedapi/<appid>/products/'
+    assert m.normalize('/1/1/') == '/<id>/<id>/'
+    assert m.normalize('/SHOP/12/') == '/SHOP/<id>/'
+    assert m.normalize('/b/5/5/7/') == '/b/5/5/<id>/'
+    assert m.normalize('/items120/7/?x=1') == '/items120/<id>/'
+    assert m.normalize('/other/?x=1') == '/other/'
+    assert URLMatcher([]).normalize('/other/?x=1') == '/other/?x=1'
+    uncached = URLMatcher(patterns, 0)
+    cached = URLMatcher(patterns, 4)
+    paths = [u1, '/1/1/', '/items7/3/?a=1', '/items7/3/?a=2', '/1/1/',
+             '/x/?y', '/x/', '/items8/4/', u1, '/1/1/#f?a']
+    for path in paths:
+        assert cached.normalize(path) == uncached.normalize(path)
+    assert (cached.hits, cached.misses) == (3, 7)
+    assert sorted(cached.cache) == ['/1/1/#f', u1.split('?')[0]]
+    assert sorted(cached.old_cache) == ['/items8/4/', '/x/']
+    assert '30.0% hits' in cached.cache_info()
+    logs = [{'method': 'GET', 'path': '/items3/1/'},
+            {'method': 'GET', 'path': '/items3/2/?page=2'}]
+    assert dynamic_urls(logs, patterns) == {('GET', '/items3/<id>/'): 2}
+
+    logs = [{'method': 'GET', 'path': '/items3/%d/' % (i + 1000,),
+             'status_code': 404 if i % 10 == 0 else 200,
+             'content_size': str(i)} for i in range(1, 101)]
+    stats = url_stats(logs, patterns)
+    endpoint = stats[('GET', '/items3/<id>/')]
+    assert endpoint.hits == 100
+    assert endpoint.statuses == {200: 90, 404: 10}
+    sizes = endpoint.percentiles()
+    for p, actual in ((50, 50), (90, 90), (99, 99)):
+        assert abs(sizes[p] - actual) <= 0.02 * actual
+    half = url_stats(logs[:50], patterns)[('GET', '/items3/<id>/')]
+    half.merge(url_stats(logs[50:], patterns)[('GET', '/items3/<id>/')])
+    assert half.to_dict() == endpoint.to_dict()
+    copy = EndpointStats.from_dict(json.loads(json.dumps(endpoint.to_dict())))
+    assert copy.to_dict() == endpoint.to_dict()
+    item, = as_json(Counter({('GET', '/items3/<id>/'): 100}), stats)
+    assert item['hits'] == 100 and item['statuses'] == {'200': 90, '404': 10}
+    assert item['sizes']['max'] == 100
+
+    logs = [{'method': 'GET', 'path': '/items%d/%d/' % (i % 3, i + 1000)}
+            for i in range(300)]
+    logs += [{'method': 'GET', 'path': '/bot/%d/' % (i,)} for i in range(500)]
+    top = top_urls(logs, patterns, 50)
+    assert len(top.counts) == 50 and top.total == 800
+    assert [k for k, _, _ in top.top(3)] == [('GET', '/items%d/<id>/' % (i,))
+                                             for i in range(3)]
+    assert top.guaranteed(3) == 3
+    assert top_as_json(top, 1)[0]['path'] == '/items0/<id>/'
+
+    import io
+    import gzip
+    import random
+    import shutil
+    import tempfile
+    line = ('1.2.3.4 - - [%02d/Nov/2012:13:15:05 +0000] "GET %s HTTP/1.1" '
+            '%d %d "-" "curl"\n')
+    lines = [line % (1 + i % 3, '/items%d/%d/' % (i % 4, i + 1000),
+                     200 if i % 5 else 404, i * 7) for i in range(300)]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        logfile = os.path.join(tmpdir, 'access.log')
+        with open(logfile, 'w') as f:
+            f.writelines(lines[:200])
+            f.write(lines[200][:20])
+        store = AggregateStore(os.path.join(tmpdir, 'store.db'), patterns)
+        matcher = URLMatcher(patterns)
+        assert store_file(store, logfile, 'raw', matcher=matcher) == 'added'
+        assert store_file(store, logfile, 'raw', matcher=matcher) == \
+            'unchanged'
+        assert store.file_state(logfile)[2] == len(''.join(lines[:200]))
+        with open(logfile, 'a') as f:
+            f.write(lines[200][20:])
+            f.writelines(lines[201:])
+        os.utime(logfile, (0, 0))
+        assert store_file(store, logfile, 'raw', matcher=matcher) == \
+            'added new lines'
+        pattern = log2json.get_pattern('apache2_access')
+        logs = list(log2json.parse_lines(lines, pattern))
+        expected = dict((k, v.to_dict()) for k, v
+                        in url_stats(logs, patterns).iteritems())
+        assert (dict((k, v.to_dict()) for k, v in store.query().iteritems())
+                == expected)
+        day2 = [l for l in logs if l['datetime'].startswith('02/')]
+        assert (dict((k, v.to_dict()) for k, v
+                     in store.query('2012-11-02', '2012-11-02').iteritems())
+                == dict((k, v.to_dict()) for k, v
+                        in url_stats(day2, patterns).iteritems()))
+        rotated = logfile + '.1'
+        os.rename(logfile, rotated)
+        with open(logfile, 'w') as f:
+            f.writelines(lines[250:])
+        assert store_file(store, logfile, 'raw', matcher=matcher) == 'added'
+        assert store_file(store, rotated, 'raw', matcher=matcher) == \
+            'unchanged'
+        with open(logfile, 'a') as f:
+            f.writelines(lines[:200])
+        assert store_file(store, logfile, 'raw', matcher=matcher) == \
+            'added new lines'
+        logs = list(log2json.parse_lines(lines + lines[250:] + lines[:200],
+                                         pattern))
+        expected = dict((k, v.to_dict()) for k, v
+                        in url_stats(logs, patterns).iteritems())
+        assert (dict((k, v.to_dict()) for k, v in store.query().iteritems())
+                == expected)
+        compressed = logfile + '.2.gz'
+        with open(rotated, 'rb') as f_in:
+            with gzip.open(compressed, 'wb') as f_out:
+                f_out.write(f_in.read())
+        os.remove(rotated)
+        assert store_file(store, compressed, 'raw', matcher=matcher) == \
+            'added'
+        assert (dict((k, v.to_dict()) for k, v in store.query().iteritems())
+                == expected)
+        store.close()
+        try:
+            AggregateStore(os.path.join(tmpdir, 'store.db'), [])
+            assert False
+        except cli.CliError:
+            pass
+    finally:
+        shutil.rmtree(tmpdir)
+    logs = [{'method': 'GET', 'path': '/items%d/%d/' % (i % 7, i + 1000),
+             'status_code': 200, 'content_size': str(i * 37 % 5000),
+             'timestamp': 1352332800.0 + i * 13} for i in range(2000)]
+    random.Random(0).shuffle(logs)
+    whole = rollup(logs, patterns, 60)
+    assert len(whole) > 7
+    assert (sum(s.hits for s in whole.itervalues()) == 2000)
+    merged = {}
+    for i in range(3):
+        f = io.BytesIO()
+        dump_rollup(rollup(logs[i::3], patterns, 60), 60, f)
+        f.seek(0)
+        bucket, partial = load_rollup(f)
+        merge_rollups(merged, partial)
+    assert bucket == 60
+    assert (dict((k, v.to_dict()) for k, v in merged.iteritems()) ==
+            dict((k, v.to_dict()) for k, v in whole.iteritems()))
+    hourly = merge_rollups({}, whole, 3600)
+    assert (dict((k, v.to_dict()) for k, v in hourly.iteritems()) ==
+            dict((k, v.to_dict()) for k, v in rollup(logs, patterns,
+                                                      3600).iteritems()))
+    totals = rollup_totals(whole)
+    assert (dict((k, v.to_dict()) for k, v in totals.iteritems()) ==
+            dict((k, v.to_dict()) for k, v
+                 in url_stats(logs, patterns).iteritems()))
+
 
 if __name__ == '__main__':
     args = docopt(__doc__)
@@ -89,7 +1044,107 @@ if __name__ == '__main__':
     else:
         patterns = None
 
-    with cli.read_input(args['FILE'], args['--stdin']) as f:
-        url_counts = dynamic_urls(json.load(f), patterns)
-        print_to_stdout(url_counts)
+    if args['--bucket'] is not None and args['--bucket'] not in BUCKETS:
+        sys.exit('Unknown bucket: %s' % (args['--bucket'],))
+    bucket = BUCKETS.get(args['--bucket'])
 
+    if args['merge']:
+        try:
+            bucket, rollups = merge_partials(args['PARTIAL'], bucket)
+        except cli.CliError as e:
+            sys.exit(str(e))
+        if args['--output']:
+            with open(args['--output'], 'w') as f:
+                dump_rollup(rollups, bucket, f)
+        stats = rollup_totals(rollups)
+        print_to_stdout(Counter(dict((k, v.hits)
+                                     for k, v in stats.iteritems())), stats)
+        sys.exit()
+
+    if args['report']:
+        if not os.path.exists(args['DB']):
+            sys.exit('No such store: %s' % (args['DB'],))
+        for date in (args['--from'], args['--to']):
+            try:
+                if date is not None:
+                    datetime.strptime(date, DAY_FORMAT)
+            except ValueError:
+                sys.exit('Invalid date, expected YYYY-MM-DD: %s' % (date,))
+        store = AggregateStore(args['DB'])
+        stats = store.query(args['--from'], args['--to'])
+        store.close()
+        url_counts = Counter(dict((k, v.hits) for k, v in stats.iteritems()))
+        print_to_stdout(url_counts, stats)
+        if args['--output']:
+            with open(args['--output'], 'w') as f:
+                json.dump(as_json(url_counts, stats), f, indent=2)
+        sys.exit()
+
+    if args['--top-k'] is not None:
+        try:
+            k, capacity = int(args['--top-k']), int(args['--max-keys'])
+        except ValueError:
+            sys.exit('--top-k and --max-keys should be numbers')
+        if capacity < k:
+            sys.exit('--max-keys should be at least --top-k')
+    try:
+        cache_size = int(args['--cache-size'])
+    except ValueError:
+        sys.exit('--cache-size should be a number')
+    matcher = URLMatcher(patterns or [], cache_size)
+
+    if args['store']:
+        try:
+            store = AggregateStore(args['DB'], patterns or [])
+        except cli.CliError as e:
+            sys.exit(str(e))
+        try:
+            for filepath in cli.expand_paths(args['FILE']):
+                result = store_file(store, filepath, args['--format'],
+                                    args['--log_pattern'], args['--compact'],
+                                    matcher)
+                print '%s: %s' % (filepath, result)
+        except cli.CliError as e:
+            sys.exit(str(e))
+        finally:
+            store.close()
+        if matcher.has_patterns and cache_size:
+            print >> sys.stderr, matcher.cache_info()
+        sys.exit()
+
+    if args['rollup']:
+        columns = ROLLUP_COLUMNS
+    elif args['--stats']:
+        columns = STATS_COLUMNS
+    else:
+        columns = COLUMNS
+    logs = read_logs(args['FILE'], args['--stdin'], args['--format'],
+                     args['--log_pattern'], args['--compact'], columns)
+    try:
+        if args['rollup']:
+            bucket = bucket or BUCKETS['minute']
+            rollups = rollup(logs, bucket=bucket, matcher=matcher)
+            with open(args['--output'], 'w') as f:
+                dump_rollup(rollups, bucket, f)
+        elif args['--top-k'] is not None:
+            top = top_urls(logs, capacity=capacity, matcher=matcher)
+            print_top(top, k)
+            if args['--output']:
+                with open(args['--output'], 'w') as f:
+                    json.dump(top_as_json(top, k), f, indent=2)
+        else:
+            if args['--stats']:
+                stats = url_stats(logs, matcher=matcher)
+                url_counts = Counter(dict((k, v.hits)
+                                          for k, v in stats.iteritems()))
+            else:
+                stats = None
+                url_counts = dynamic_urls(logs, matcher=matcher)
+            print_to_stdout(url_counts, stats)
+            if args['--output']:
+                with open(args['--output'], 'w') as f:
+                    json.dump(as_json(url_counts, stats), f, indent=2)
+    except cli.CliError as e:
+        sys.exit(str(e))
+    if matcher.has_patterns and cache_size:
+        print >> sys.stderr, matcher.cache_info()
@@ -0,0 +1,578 @@
+"""Benchmarks for the log tooling
+
+Generates realistic apache access logs and mysql general logs of
+configurable size and cardinality, runs the hot paths of the tools on
+them and reports lines/sec, peak RSS and timings of every stage.
+
+For help, run following command in terminal::
+
+    $ python logbench.py -h
+
+Examples::
+
+    $ python logbench.py timestamps -n 100000
+    $ python logbench.py generate -s 1GB --access-log access.log
+    $ python logbench.py pipeline -s 200MB -r bench.json
+    $ python logbench.py records -s 200MB
+    $ python logbench.py urlmatch -n 20000
+
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import Queue
+import random
+import shutil
+import argparse
+import datetime
+import platform
+import resource
+import tempfile
+import traceback
+import multiprocessing
+
+import log2json
+import splitlogs
+import logan
+import mysql_log_analyzer
+from dateutil import parser as dateparser
+
+
+SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+START_TIME = datetime.datetime(2012, 11, 8, 0, 0, 0)
+
+METHODS = ['GET'] * 8 + ['POST'] * 2 + ['HEAD', 'PUT']
+
+STATUS_CODES = [200] * 16 + [304] * 2 + [404, 500, 302, 403]
+
+USER_AGENTS = [
+    'Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:16.0) Gecko/20100101 Firefox/16.0',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.11 (KHTML, like Gecko) Chrome/23.0.1271.64 Safari/537.11',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'curl/7.27.0',
+]
+
+# Numbers of url patterns the `urlmatch` benchmark is run with
+PATTERN_COUNTS = [10, 50, 100, 200, 400]
+
+REFERRERS = ['-', 'http://www.google.com/', 'http://example.com/']
+
+QUERY_TEMPLATES = [
+    "SELECT * FROM table{t} WHERE id = {n}",
+    "SELECT name, email FROM table{t} WHERE name = 'user{n}' LIMIT 10",
+    "UPDATE table{t} SET counter = counter + 1 WHERE id = {n}",
+    "INSERT INTO table{t} (a, b, c) VALUES ({n}, 'value{n}', NOW())",
+    "DELETE FROM table{t} WHERE id IN ({n}, {m}, {k})",
+]
+
+
+def parse_size(size):
+    """Parses sizes such as `500KB`, `20MB` or `2GB` to bytes
+
+    :param size: str
+    :rtype: int
+
+    """
+    size = size.strip().upper()
+    number = size.rstrip('KMGB')
+    return int(float(number) * SIZE_UNITS[size[len(number):]])
+
+
+def skewed_choice(rnd, n):
+    """Picks an index in range(n) such that lower indexes are far more
+    likely, like the popularity of urls and queries
+
+    """
+    return min(int(rnd.expovariate(8.0 / n)), n - 1)
+
+
+def url_patterns(patterns):
+    """Url patterns (in the format of the logan pattern file) matching
+    the urls produced by `generate_access_log`
+
+    :param patterns: int, number of patterns
+    :rtype: list of str
+
+    """
+    return [r'/api/v1/resource%d/(?P<id%d>\d+)/' % (i, i)
+            for i in xrange(patterns)]
+
+
+def generate_access_log(out, size, urls=10000, patterns=50, seed=0):
+    """Writes an apache2 access log of about `size` bytes to out
+
+    :param out: file like object
+    :param size: int, bytes
+    :param urls: int, number of distinct paths (without query string)
+    :param patterns: int, number of url patterns the paths belong to
+    :param seed: int
+    :rtype: int, number of lines written
+
+    """
+    rnd = random.Random(seed)
+    ids = max(urls // patterns, 1)
+    ips = ['%d.%d.%d.%d' % (rnd.randint(1, 223), rnd.randint(0, 255),
+                            rnd.randint(0, 255), rnd.randint(1, 254))
+           for _ in xrange(1000)]
+    written = lines = 0
+    second = 0
+    batch = []
+    while written < size:
+        second += rnd.randint(0, 1)
+        dt = (START_TIME + datetime.timedelta(seconds=second))
+        i = skewed_choice(rnd, urls)
+        path = '/api/v1/resource%d/%d/' % (i % patterns, i // patterns % ids)
+        if rnd.random() < 0.2:
+            path += '?page=%d' % (rnd.randint(1, 50),)
+        line = '%s - - [%s] "%s %s HTTP/1.1" %d %d "%s" "%s"\n' % (
+            rnd.choice(ips), dt.strftime('%d/%b/%Y:%H:%M:%S +0000'),
+            rnd.choice(METHODS), path, rnd.choice(STATUS_CODES),
+            rnd.randint(0, 50000), rnd.choice(REFERRERS),
+            rnd.choice(USER_AGENTS))
+        batch.append(line)
+        written += len(line)
+        lines += 1
+        if len(batch) >= 10000:
+            out.write(''.join(batch))
+            batch = []
+    out.write(''.join(batch))
+    return lines
+
+
+def generate_mysql_log(out, size, queries=10000, seed=0):
+    """Writes a mysql general query log of about `size` bytes to out
+
+    :param out: file like object
+    :param size: int, bytes
+    :param queries: int, number of distinct query strings
+    :param seed: int
+    :rtype: int, number of lines written
+
+    """
+    rnd = random.Random(seed)
+    literals = max(queries // len(QUERY_TEMPLATES), 1)
+    written = lines = 0
+    second = 0
+    batch = []
+    while written < size:
+        thread = rnd.randint(1, 200)
+        prefix = '\t\t'
+        if rnd.random() < 0.3:
+            second += 1
+            dt = START_TIME + datetime.timedelta(seconds=second)
+            prefix = dt.strftime('%y%m%d %H:%M:%S\t')
+        r = rnd.random()
+        if r < 0.02:
+            line = '%s%6d Connect\troot@localhost on db%d\n' % (
+                prefix, thread, thread % 5)
+        elif r < 0.04:
+            line = '%s%6d Quit\t\n' % (prefix, thread)
+        else:
+            i = skewed_choice(rnd, literals * len(QUERY_TEMPLATES))
+            query = QUERY_TEMPLATES[i % len(QUERY_TEMPLATES)].format(
+                t=i % 20, n=i // len(QUERY_TEMPLATES), m=i + 1, k=i + 2)
+            line = '%s%6d Query\t%s\n' % (prefix, thread, query)
+        batch.append(line)
+        written += len(line)
+        lines += 1
+        if len(batch) >= 10000:
+            out.write(''.join(batch))
+            batch = []
+    out.write(''.join(batch))
+    return lines
+
+
+class CountingFile(object):
+    """Wraps a file to count the lines that are read from it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.lines = 0
+
+    def __iter__(self):
+        for line in self.f:
+            self.lines += 1
+            yield line
+
+
+def stage_parse_line(options):
+    """Parses every line of the access log with log2json"""
+    pattern = log2json.get_pattern('apache2_access')
+    lines = 0
+    start = time.time()
+    with open(options['access_log']) as f:
+        for line in f:
+            log2json.parse_line(line, pattern)
+            lines += 1
+    return {'lines': lines, 'seconds': time.time() - start}
+
+
+def stage_split(options):
+    """Extracts the first day of the access log with splitlogs"""
+    day = START_TIME.strftime('%d/%b/%Y')
+    pattern = splitlogs.get_date_pattern(splitlogs.parse_date(day))
+    start = time.time()
+    with open(options['access_log']) as f:
+        f = CountingFile(f)
+        for line in splitlogs.split(f, pattern):
+            pass
+    return {'lines': f.lines, 'seconds': time.time() - start}
+
+
+def stage_dynamic_urls(options):
+    """Parses the access log and counts the urls by pattern with logan,
+    streaming the logs as logan does so memory use doesn't depend on
+    the size of the log
+
+    """
+    pattern = log2json.get_pattern('apache2_access')
+    start = time.time()
+    with open(options['access_log']) as f:
+        f = CountingFile(f)
+        logan.dynamic_urls(log2json.parse_lines(f, pattern),
+                           url_patterns(options['patterns']))
+    return {'lines': f.lines, 'seconds': time.time() - start}
+
+
+def stage_aggregate(options):
+    """Puts the entries of the mysql log back together and counts the
+    queries by fingerprint, as mysql_log_analyzer does"""
+    start = time.time()
+    with open(options['mysql_log']) as f:
+        f = CountingFile(f)
+        list(mysql_log_analyzer.sorted_counts(
+            mysql_log_analyzer.count_lines(f)))
+    return {'lines': f.lines, 'seconds': time.time() - start}
+
+
+# Stages of the pipeline benchmark along with the input they run on
+STAGES = [
+    ('log2json.parse_line', 'access_log', stage_parse_line),
+    ('splitlogs.split', 'access_log', stage_split),
+    ('logan.dynamic_urls', 'access_log', stage_dynamic_urls),
+    ('mysql_log_analyzer.count_lines', 'mysql_log', stage_aggregate),
+]
+
+
+def stage_records(options):
+    """Keeps all the parsed logs of the access log in a list, as dicts
+    or as compact records depending on the `compact` option
+
+    """
+    pattern = log2json.get_pattern('apache2_access')
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    with open(options['access_log']) as f:
+        logs = list(log2json.parse_lines(f, pattern, options['compact']))
+    return {'lines': len(logs), 'seconds': time.time() - start,
+            'base_rss_kb': base_rss}
+
+
+class StageError(Exception):
+    pass
+
+
+def _run_stage(func, options, queue):
+    try:
+        result = func(options)
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+        return
+    result['peak_rss_kb'] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss
+    queue.put(result)
+
+
+def run_stage(name, input_key, func, options):
+    """Runs a stage in a child process so that its peak RSS isn't
+    affected by the other stages
+
+    :param name: str
+    :param input_key: str, key of the input file in options
+    :param func: callable taking the options dict
+    :param options: dict
+    :rtype: dict
+    :raises StageError: if the stage failed or its process died
+
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_stage,
+                                   args=(func, options, queue))
+    proc.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            if proc.exitcode is not None and queue.empty():
+                raise StageError('Stage %s exited with code %d' %
+                                 (name, proc.exitcode))
+    proc.join()
+    if 'error' in result:
+        raise StageError('Stage %s failed:\n%s' % (name, result['error']))
+    filepath = options[input_key]
+    size = os.path.getsize(filepath)
+    result.update({
+        'stage': name,
+        'input': filepath,
+        'input_bytes': size,
+        'lines_per_sec': result['lines'] / result['seconds'],
+        'bytes_per_sec': size / result['seconds'],
+    })
+    return result
+
+
+def generate(args):
+    """The `generate` command"""
+    size = parse_size(args.size)
+    if args.access_log:
+        with open(args.access_log, 'w') as f:
+            generate_access_log(f, size, args.urls, args.patterns,
+                                args.seed)
+    if args.mysql_log:
+        with open(args.mysql_log, 'w') as f:
+            generate_mysql_log(f, size, args.queries, args.seed)
+    if args.pattern_file:
+        with open(args.pattern_file, 'w') as f:
+            json.dump(url_patterns(args.patterns), f)
+
+
+def prepare_inputs(args, workdir, keys):
+    """Generates the input logs in workdir, unless existing files are
+    given in args
+
+    :param args: argparse.Namespace
+    :param workdir: str
+    :param keys: list of `access_log` and/or `mysql_log`
+    :rtype: tuple of (options dict for the stages, inputs dict for
+            the report)
+
+    """
+    size = parse_size(args.size)
+    options = {'patterns': args.patterns}
+    inputs = {}
+    for key in keys:
+        filepath = getattr(args, key)
+        if filepath is None or not os.path.exists(filepath):
+            filepath = os.path.join(workdir, key)
+            with open(filepath, 'w') as f:
+                if key == 'access_log':
+                    generate_access_log(f, size, args.urls, args.patterns,
+                                        args.seed)
+                else:
+                    generate_mysql_log(f, size, args.queries, args.seed)
+        options[key] = filepath
+        inputs[key] = {'path': filepath, 'bytes': os.path.getsize(filepath)}
+    return options, inputs
+
+
+def write_report(args, inputs, results):
+    """Writes the json report of a benchmark run if asked for"""
+    if not args.report:
+        return
+    report = {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'options': {'size': parse_size(args.size), 'urls': args.urls,
+                    'queries': args.queries, 'patterns': args.patterns,
+                    'seed': args.seed},
+        'inputs': inputs,
+        'stages': results,
+    }
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def bench_pipeline(args):
+    """The `pipeline` benchmark"""
+    workdir = tempfile.mkdtemp(prefix='logbench')
+    try:
+        options, inputs = prepare_inputs(args, workdir,
+                                         ['access_log', 'mysql_log'])
+        stages = [s for s in STAGES
+                  if not args.stages or s[0] in args.stages]
+        results = []
+        for name, input_key, func in stages:
+            result = run_stage(name, input_key, func, options)
+            results.append(result)
+            print('{stage:>30}: {lines_per_sec:12.0f} lines/sec '
+                  '{seconds:8.2f}s {peak_rss_kb:10d} KB peak RSS'
+                  .format(**result))
+        write_report(args, inputs, results)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_records(args):
+    """The `records` benchmark, compares the memory used for keeping
+    all the parsed logs as dicts and as compact records
+
+    """
+    workdir = tempfile.mkdtemp(prefix='logbench')
+    try:
+        options, inputs = prepare_inputs(args, workdir, ['access_log'])
+        results = []
+        for name, compact in [('dict', False), ('LogRecord', True)]:
+            options['compact'] = compact
+            result = run_stage(name, 'access_log', stage_records, options)
+            result['retained_kb'] = (result['peak_rss_kb'] -
+                                     result['base_rss_kb'])
+            result['bytes_per_log'] = (result['retained_kb'] * 1024.0 /
+                                       result['lines'])
+            results.append(result)
+            print('{stage:>10}: {retained_kb:10d} KB for {lines} logs '
+                  '({bytes_per_log:.0f} bytes/log) '
+                  '{lines_per_sec:10.0f} lines/sec'.format(**result))
+        write_report(args, inputs, results)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def sample_paths(n, patterns, seed=0):
+    """Generates n request paths matching `url_patterns(patterns)`,
+    spread evenly over the patterns
+
+    """
+    rnd = random.Random(seed)
+    return ['/api/v1/resource%d/%d/?page=%d' % (rnd.randint(0, patterns - 1),
+                                               rnd.randint(1, 100000),
+                                               rnd.randint(1, 50))
+            for _ in xrange(n)]
+
+
+def bench_urlmatch(args):
+    """The `urlmatch` benchmark, compares trying the url patterns one
+    by one with the combined logan.URLMatcher as the number of
+    patterns grows
+
+    """
+    for count in PATTERN_COUNTS:
+        patterns = url_patterns(count)
+        paths = sample_paths(args.lines, count, args.seed)
+        compiled = map(re.compile, patterns)
+
+        def one_by_one(path):
+            for p in compiled:
+                path = logan.path_pattern(path, p)
+            return path
+
+        matcher = logan.URLMatcher(patterns)
+        assert map(one_by_one, paths[:100]) == map(matcher.normalize,
+                                                     paths[:100])
+        naive = lines_per_sec(one_by_one, paths)
+        combined = lines_per_sec(matcher.normalize, paths)
+        print('{count:>5} patterns: {naive:10.0f} lines/sec one by one, '
+              '{combined:10.0f} lines/sec combined ({x:.1f}x)'.format(
+                  count=count, naive=naive, combined=combined,
+                  x=combined / naive))
+
+
+def sample_datetimes(n, lines_per_second=10):
+    """Generates n apache log datetime strs, with `lines_per_second`
+    consecutive lines sharing the same second as in real access logs
+
+    :param n: int
+    :param lines_per_second: int
+    :rtype: list of str
+
+    """
+    start = datetime.datetime(2012, 11, 8, 13, 15, 5)
+    return [(start + datetime.timedelta(seconds=i // lines_per_second))
+            .strftime('%d/%b/%Y:%H:%M:%S +0530')
+            for i in xrange(n)]
+
+
+def dateutil_timestamp(value):
+    """The fuzzy dateutil based conversion that `parse_line` used to do
+    for every line, used as the baseline
+
+    """
+    return log2json.datetime_to_timestamp(dateparser.parse(value, fuzzy=True))
+
+
+def lines_per_sec(func, values):
+    """Calls func on each of the values and returns the throughput
+
+    :param func: callable
+    :param values: list
+    :rtype: float
+
+    """
+    start = time.time()
+    for v in values:
+        func(v)
+    return len(values) / (time.time() - start)
+
+
+def bench_timestamps(args):
+    """The `timestamps` benchmark"""
+    values = sample_datetimes(args.lines, args.lines_per_second)
+    results = [
+        ('dateutil', lines_per_sec(dateutil_timestamp, values)),
+        ('apache_timestamp', lines_per_sec(log2json.apache_timestamp,
+                                           values)),
+    ]
+    baseline = results[0][1]
+    for name, rate in results:
+        print('{name:>20}: {rate:12.0f} lines/sec ({x:.1f}x)'.format(
+            name=name, rate=rate, x=rate / baseline))
+
+
+BENCHMARKS = {
+    'timestamps': bench_timestamps,
+    'pipeline': bench_pipeline,
+    'records': bench_records,
+    'urlmatch': bench_urlmatch,
+    'generate': generate,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark',
+                        help=(
+                            'benchmark to run, or `generate` to only '
+                            'write the synthetic logs'
+                        ), choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('-n', '--lines', type=int, default=100000,
+                        help='number of lines to generate')
+    parser.add_argument('--lines-per-second', type=int, default=10,
+                        help='number of consecutive lines sharing a second')
+    parser.add_argument('-s', '--size', default='10MB',
+                        help='size of the generated logs eg. 500KB, 2GB')
+    parser.add_argument('--urls', type=int, default=10000,
+                        help='number of distinct urls in the access log')
+    parser.add_argument('--patterns', type=int, default=50,
+                        help='number of url patterns the urls belong to')
+    parser.add_argument('--queries', type=int, default=10000,
+                        help='number of distinct queries in the mysql log')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the random generator')
+    parser.add_argument('--access-log',
+                        help=(
+                            'access log to write to (generate) or to '
+                            'use instead of a generated one'
+                        ))
+    parser.add_argument('--mysql-log',
+                        help=(
+                            'mysql general log to write to (generate) or '
+                            'to use instead of a generated one'
+                        ))
+    parser.add_argument('--pattern-file',
+                        help='logan pattern file to write to (generate)')
+    parser.add_argument('--stages', nargs='+',
+                        help='stages to run, all of them by default',
+                        choices=[s[0] for s in STAGES])
+    parser.add_argument('-r', '--report',
+                        help='file to write the json report to')
+    args = parser.parse_args()
+    try:
+        BENCHMARKS[args.benchmark](args)
+    except StageError as e:
+        sys.exit(str(e))
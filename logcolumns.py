@@ -0,0 +1,314 @@
+"""A compact columnar binary format for parsed logs
+
+The logs are stored column by column. String fields (path,
+user_agent, referrer, method etc.) are dictionary encoded ie. each
+distinct value is stored once and the rows only hold an index into
+the dictionary. Numeric fields (timestamp, status_code and
+content_size) are stored as packed arrays.
+
+Layout of a file::
+
+    MAGIC | header length (uint32) | json header | column blocks...
+
+The header has the number of rows and, for every column, where its
+block starts and how it's encoded so that a reader can load only the
+columns it needs. A dictionary encoded block is made of the lengths
+of the dictionary entries (uint32), the entries themselves and the
+row indexes. All numbers are little endian.
+
+"""
+
+import sys
+import json
+import struct
+import itertools
+from array import array
+
+
+MAGIC = 'LOGCOL1\n'
+
+# Columns stored as packed arrays, mapped to the array typecode and
+# the type their values are converted to. Every other column is
+# dictionary encoded
+NUMERIC_COLUMNS = {
+    'timestamp': ('d', float),
+    'status_code': ('H', int),
+    'content_size': ('d', int),
+}
+
+# Dictionary entry length used to store None
+NULL_LENGTH = 0xffffffff
+
+# Bytes read at a time when skipping the blocks of a stream
+SKIP_CHUNK = 1024 * 1024
+
+
+def _index_typecode(entries):
+    """Smallest array typecode that can index a dictionary"""
+    if entries <= 0xff:
+        return 'B'
+    elif entries <= 0xffff:
+        return 'H'
+    return 'I'
+
+
+def _to_bytes(arr):
+    """Little endian bytes of an array"""
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tostring()
+
+
+def _from_bytes(typecode, data):
+    """Array from little endian bytes"""
+    arr = array(typecode)
+    arr.fromstring(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+class DictColumn(object):
+    """Dictionary encoded column being written"""
+
+    def __init__(self):
+        self.entries = []
+        self.positions = {}
+        self.indexes = array('I')
+
+    def append(self, value):
+        try:
+            i = self.positions[value]
+        except KeyError:
+            i = self.positions[value] = len(self.entries)
+            self.entries.append(value)
+        self.indexes.append(i)
+
+    def blocks(self):
+        lengths = array('I', (NULL_LENGTH if v is None else len(v)
+                              for v in self.entries))
+        yield _to_bytes(lengths)
+        yield ''.join(v for v in self.entries if v is not None)
+        yield _to_bytes(array(_index_typecode(len(self.entries)),
+                              self.indexes))
+
+    def header(self):
+        blob_size = sum(len(v) for v in self.entries if v is not None)
+        typecode = _index_typecode(len(self.entries))
+        return {
+            'kind': 'dict',
+            'entries': len(self.entries),
+            'blob_size': blob_size,
+            'typecode': typecode,
+            'size': (len(self.entries) * 4 + blob_size +
+                     len(self.indexes) * array(typecode).itemsize),
+        }
+
+
+class NumericColumn(object):
+    """Packed array column being written"""
+
+    def __init__(self, typecode, cast):
+        self.values = array(typecode)
+        self.cast = cast
+
+    def append(self, value):
+        self.values.append(self.cast(value))
+
+    def blocks(self):
+        yield _to_bytes(self.values)
+
+    def header(self):
+        return {
+            'kind': 'numeric',
+            'typecode': self.values.typecode,
+            'size': len(self.values) * self.values.itemsize,
+        }
+
+
+def write_columns(logs, out):
+    """Writes logs to out in the columnar format
+
+    All the logs are expected to have the same fields, as is the case
+    with the logs parsed using a single pattern. Only the encoded
+    columns are held in memory while the logs are consumed.
+
+    :param logs: iterable of dicts
+    :param out: file like object opened in binary mode
+    :rtype: int, number of rows written
+
+    """
+    names = None
+    columns = []
+    rows = 0
+    for log in logs:
+        if names is None:
+            names = sorted(log.keys())
+            for name in names:
+                if name in NUMERIC_COLUMNS:
+                    columns.append(NumericColumn(*NUMERIC_COLUMNS[name]))
+                else:
+                    columns.append(DictColumn())
+        for name, column in itertools.izip(names, columns):
+            column.append(log[name])
+        rows += 1
+
+    headers = []
+    offset = 0
+    for name, column in itertools.izip(names or [], columns):
+        header = column.header()
+        header['name'] = name
+        header['offset'] = offset
+        offset += header['size']
+        headers.append(header)
+    header = json.dumps({'rows': rows, 'columns': headers})
+    out.write(MAGIC)
+    out.write(struct.pack('<I', len(header)))
+    out.write(header)
+    for column in columns:
+        for block in column.blocks():
+            out.write(block)
+    return rows
+
+
+def read_header(f):
+    """Reads the header of a columnar log file, from the current
+    position of f
+
+    :param f: file like object opened in binary mode
+    :rtype: dict with the number of `rows`, the `columns` and the
+            offset of the first column block (`data_start`)
+
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a columnar log file')
+    size, = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(size))
+    header['data_start'] = len(MAGIC) + 4 + size
+    return header
+
+
+def _skip(f, size):
+    """Moves f forward by size bytes, reading them if f is a stream
+    (eg. stdin) that can't seek"""
+    try:
+        f.seek(size, 1)
+    except (IOError, ValueError):
+        while size > 0:
+            data = f.read(min(size, SKIP_CHUNK))
+            if not data:
+                return
+            size -= len(data)
+
+
+def _read_column(f, column):
+    """Reads and decodes a single column block, at the current position
+    of f"""
+    if column['kind'] == 'numeric':
+        values = _from_bytes(column['typecode'], f.read(column['size']))
+        cast = NUMERIC_COLUMNS.get(column['name'], (None, float))[1]
+        return map(cast, values)
+    lengths = _from_bytes('I', f.read(column['entries'] * 4))
+    blob = f.read(column['blob_size'])
+    entries = []
+    pos = 0
+    for length in lengths:
+        if length == NULL_LENGTH:
+            entries.append(None)
+        else:
+            entries.append(blob[pos:pos + length])
+            pos += length
+    indexes = _from_bytes(column['typecode'],
+                          f.read(column['size'] - len(lengths) * 4 -
+                                 len(blob)))
+    return [entries[i] for i in indexes]
+
+
+def read_columns(f, columns=None):
+    """Reads the requested columns from a columnar log file. Blocks of
+    the other columns are skipped without being decoded. The blocks are
+    read in order without seeking back, so f may be a stream such as
+    stdin
+
+    :param f: file like object opened in binary mode, at the start of
+              the columnar data
+    :param columns: list of column names, all of them if None
+    :rtype: dict of column name -> list of values
+
+    """
+    header = read_header(f)
+    available = dict((c['name'], c) for c in header['columns'])
+    if columns is None:
+        columns = sorted(available.keys())
+    for name in columns:
+        if name not in available:
+            raise ValueError('No such column: %s' % (name,))
+    wanted = set(columns)
+    result = {}
+    position = 0
+    for column in sorted(header['columns'], key=lambda c: c['offset']):
+        if column['name'] not in wanted:
+            continue
+        _skip(f, column['offset'] - position)
+        result[column['name']] = _read_column(f, column)
+        position = column['offset'] + column['size']
+    return result
+
+
+def iter_records(f, columns=None):
+    """Generator of logs as dicts, having only the requested columns
+
+    :param f: file like object opened in binary mode
+    :param columns: list of column names, all of them if None
+    :rtype: generator of dicts
+
+    """
+    data = read_columns(f, columns)
+    names = data.keys()
+    for values in itertools.izip(*[data[n] for n in names]):
+        yield dict(itertools.izip(names, values))
+
+
+def test():
+    """Tests (Use nosetests to run them)"""
+    import io
+    logs = [
+        {'path': '/a', 'method': 'GET', 'status_code': 200,
+         'content_size': '503', 'timestamp': 1352380505.0, 'x': None},
+        {'path': '/b', 'method': 'GET', 'status_code': 404,
+         'content_size': '0', 'timestamp': 1352380506.0, 'x': 'y'},
+        {'path': '/a', 'method': 'POST', 'status_code': 200,
+         'content_size': '12', 'timestamp': 1352380506.0, 'x': None},
+    ]
+    f = io.BytesIO()
+    assert write_columns(logs, f) == 3
+    f.seek(0)
+    cols = read_columns(f, ['path', 'status_code', 'content_size'])
+    assert cols['path'] == ['/a', '/b', '/a']
+    assert cols['status_code'] == [200, 404, 200]
+    assert cols['content_size'] == [503, 0, 12]
+    f.seek(0)
+    records = list(iter_records(f))
+    assert records[1] == dict(logs[1], content_size=0)
+    assert [r['x'] for r in records] == [None, 'y', None]
+
+    class Stream(object):
+        """Like stdin, can only be read forward"""
+        def __init__(self, data):
+            self.f = io.BytesIO(data)
+
+        def read(self, size=-1):
+            return self.f.read(size)
+
+        def seek(self, offset, whence=0):
+            raise IOError('Illegal seek')
+
+    stream = Stream(f.getvalue())
+    assert read_columns(stream, ['status_code', 'path']) == dict(
+        (k, cols[k]) for k in ['status_code', 'path'])
+
+    f = io.BytesIO()
+    assert write_columns([], f) == 0
+    f.seek(0)
+    assert read_columns(f) == {}
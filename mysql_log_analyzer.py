@@ -1,19 +1,582 @@
+import io
+import os
 import re
+import cgi
+import csv
+import sys
+import json
+import heapq
+import argparse
+import itertools
+import multiprocessing
 from collections import defaultdict
 import datetime
 
-pattern = re.compile(r'(?i).+(query\t(select|update|insert|delete).+)\n')
+import cli
+from sketches import QuantileSketch
 
+# The queries that are counted must start with one of the verbs (all
+# of them 6 chars long)
+QUERY_VERBS = frozenset(['select', 'update', 'insert', 'delete'])
 
-def match_query(line):
-    m = pattern.match(line) 
-    if m is not None:
-        return m.groups()[0]
+# Bytes of a log file matched by a worker process at a time
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# Literals (strings, hex and decimal numbers), replaced in a single
+# pass. The lookahead makes the regex fail fast where no literal starts
+LITERALS = r"""
+    '(?:[^'\\]|\\.|'')*'           # single quoted string
+  | "(?:[^"\\]|\\.|"")*"           # double quoted string
+  | \b0x[0-9a-f]+\b                 # hex number
+  | (?<![\w$`.])[0-9]+(?:\.[0-9]+)?(?:e[+-]?[0-9]+)?\b  # number
+"""
+
+LITERAL_RE = re.compile(r"""(?=['"0-9])(?:%s)""" % LITERALS, re.I | re.X)
+
+# Comments are matched in the same pass as the literals, so that a # or
+# -- inside a string doesn't cut the query, nor a quote inside a
+# comment start a string. As in MySQL, -- must be followed by a space
+COMMENT_OR_LITERAL_RE = re.compile(r"""(?=['"0-9/#-])(?:
+    (/\*.*?\*/|\#[^\n]*|--(?=\s|$)[^\n]*)
+  | %s
+)""" % LITERALS, re.I | re.X | re.S)
+
+# A minus sign before a literal, after an operator, a `(` or a `,`, is
+# part of the literal rather than a subtraction
+NEGATIVE_RE = re.compile(r'(?<=[=<>(,*/+%])( ?)-\?')
+
+IN_LIST_RE = re.compile(r'\bin ?\(\?(?:, \?)*\)')
+
+VALUES_RE = re.compile(r'\bvalues ?\(.*?\)(?:, \(.*?\))*'
+                       r'(?= on duplicate key update|$)')
+
+# Comparison, shift, json and assignment operators get spaces around
+# them, the longest ones listed first so that they aren't split.
+# Splitting on the operators and joining the parts is faster than
+# re.sub with a template
+OPERATOR_RE = re.compile(r'(<=>|->>|->|<<|>>|<=|>=|<>|!=|:=|[=<>!])')
+
+
+def _replace_token(match):
+    return ' ' if match.group(1) is not None else '?'
+
+
+def fingerprint(query):
+    """Normalized shape of a query, the same for queries which only
+    differ by their literals, the length of their IN lists or rows of
+    values, comments, whitespace or case
+
+    :param query: str
+    :rtype: str
+
+    """
+    if '/*' in query or '--' in query or '#' in query:
+        query = COMMENT_OR_LITERAL_RE.sub(_replace_token, query).lower()
+    else:
+        query = LITERAL_RE.sub('?', query).lower()
+    query = ' '.join(OPERATOR_RE.split(query)).replace(',', ', ')
+    query = ' '.join(query.split()).replace(' ,', ',')
+    if '-?' in query:
+        query = NEGATIVE_RE.sub(r'\1?', query)
+    if 'in' in query:
+        query = IN_LIST_RE.sub('in (?+)', query)
+    if 'values' in query:
+        query = VALUES_RE.sub('values (?+)', query)
+    return query
+
+
+def count_fingerprints(queries, counts=None):
+    """Counts the queries by fingerprint, keeping the first query of
+    each fingerprint as a sample. Memory use depends on the number of
+    distinct fingerprints rather than of distinct queries
+
+    :param queries: iterable of str
+    :param counts: dict, to add the counts to [default: None]
+    :rtype: dict of fingerprint -> [count, sample]
+
+    """
+    counts = {} if counts is None else counts
+    for q in queries:
+        fp = fingerprint(q)
+        try:
+            counts[fp][0] += 1
+        except KeyError:
+            counts[fp] = [1, q]
+    return counts
+
+
+def merge_counts(counts, other):
+    """Adds the counts of `other` to `counts`, keeping the samples of
+    `counts` for the fingerprints found in both
+
+    :param counts: dict, as returned by `count_fingerprints`
+    :param other: dict, as returned by `count_fingerprints`
+    :rtype: dict, counts
+
+    """
+    for fp, (c, sample) in other.iteritems():
+        try:
+            counts[fp][0] += c
+        except KeyError:
+            counts[fp] = [c, sample]
+    return counts
+
+
+def sorted_counts(counts, n=None):
+    """Fingerprint counts, most frequent first
+
+    Without `n`, the fingerprints are put in a heap and popped as the
+    rows are consumed, so the first rows of a report are written
+    without sorting all of them first
+
+    :param counts: dict, as returned by `count_fingerprints`
+    :param n: int, to only get the top n, selected with a heap instead
+              of sorting all the fingerprints [default: None]
+    :rtype: list of (count, fingerprint, sample) tuples, a generator
+            of them without n
+
+    """
+    if n is not None:
+        items = ((c, fp, sample) for fp, (c, sample) in counts.iteritems())
+        return heapq.nsmallest(n, items, key=lambda x: (-x[0], x[1]))
+    return _popped_counts(counts)
+
+
+def _popped_counts(counts):
+    heap = [(-c, fp) for fp, (c, _) in counts.iteritems()]
+    heapq.heapify(heap)
+    while heap:
+        c, fp = heapq.heappop(heap)
+        yield -c, fp, counts[fp][1]
+
+
+def aggregate_fingerprints(queries):
+    """Same as `count_fingerprints` but returns the sorted counts
+
+    :param queries: iterable of str
+    :rtype: list of (count, fingerprint, sample) tuples, most frequent
+            first
+
+    """
+    return list(sorted_counts(count_fingerprints(queries)))
+
+
+# Header line of an entry of the slow log with its stats
+SLOW_STATS_RE = re.compile(r'# Query_time: ([\d.]+)\s+Lock_time: ([\d.]+)'
+                           r'\s+Rows_sent: (\d+)\s+Rows_examined: (\d+)')
+
+# Lines written to the logs when the server starts, the first one
+# being eg. `/usr/sbin/mysqld, Version: 5.5.28-log (...). started with:`
+SLOW_PREAMBLE = ('Tcp port:', 'Time                 Id Command')
+VERSION_LINE_RE = re.compile(r'\S+, Version: .* started with:')
+
+# Max size of the query of an entry kept in memory, the rest of it is
+# dropped
+MAX_QUERY_SIZE = 1024 * 1024
+
+
+def is_preamble(line):
+    """Whether a line is one of those written when the server starts,
+    rather than a line of a multi-line query"""
+    if line.startswith(SLOW_PREAMBLE):
+        return True
+    return ', Version: ' in line and VERSION_LINE_RE.match(line) is not None
+
+
+def _slow_entry(entry, query):
+    query = ''.join(query).strip()
+    if query.endswith(';'):
+        query = query[:-1]
+    entry['query'] = query
+    return entry
+
+
+def parse_slow_log(lines):
+    """Generator of the entries of a slow query log. An entry is made of
+    `# ` header lines (Time, User@Host, Query_time etc.) followed by the
+    `use db` and `SET timestamp` statements and the query, which may
+    span many lines. Only one entry is held in memory at a time
+
+    :param lines: iterable of str
+    :rtype: generator of dicts with the query_time, lock_time,
+            rows_sent, rows_examined, db and query of the entries
+
+    """
+    entry, query, size = None, [], 0
+    # `use db` is only written when the db differs from the one of the
+    # previous entry
+    db = None
+    for line in lines:
+        if line.startswith('#'):
+            if entry is not None and query:
+                yield _slow_entry(entry, query)
+                entry, query, size = None, [], 0
+            if line.startswith('# Query_time:'):
+                m = SLOW_STATS_RE.match(line)
+                if m is not None:
+                    entry = {
+                        'query_time': float(m.group(1)),
+                        'lock_time': float(m.group(2)),
+                        'rows_sent': int(m.group(3)),
+                        'rows_examined': int(m.group(4)),
+                        'db': db,
+                    }
+        elif is_preamble(line):
+            if entry is not None and query:
+                yield _slow_entry(entry, query)
+            entry, query, size, db = None, [], 0, None
+        elif entry is None:
+            continue
+        elif not query and line[:4].lower() == 'use ':
+            db = entry['db'] = line[4:].strip().rstrip(';').strip('`')
+        elif not query and line[:14].lower() == 'set timestamp=':
+            continue
+        elif size < MAX_QUERY_SIZE:
+            query.append(line[:MAX_QUERY_SIZE - size])
+            size += len(query[-1])
+    if entry is not None and query:
+        yield _slow_entry(entry, query)
+
+
+class SlowQueryStats(object):
+    """Query times and rows examined of the queries of a fingerprint,
+    in bounded memory, with the first query as a sample"""
+
+    def __init__(self, sample):
+        self.sample = sample
+        self.count = 0
+        self.lock_time = 0.0
+        self.query_times = QuantileSketch()
+        self.rows_examined = QuantileSketch()
+
+    def add(self, entry):
+        self.count += 1
+        self.lock_time += entry['lock_time']
+        self.query_times.add(entry['query_time'])
+        self.rows_examined.add(entry['rows_examined'])
+
+    def merge(self, other):
+        self.count += other.count
+        self.lock_time += other.lock_time
+        self.query_times.merge(other.query_times)
+        self.rows_examined.merge(other.rows_examined)
+
+    def summary(self):
+        """Totals, means and percentiles as a dict"""
+        times, rows = self.query_times, self.rows_examined
+        return {
+            'count': self.count,
+            'total_time': times.total,
+            'mean_time': times.mean(),
+            'p95_time': times.quantile(0.95),
+            'p99_time': times.quantile(0.99),
+            'max_time': times.max,
+            'lock_time': self.lock_time,
+            'total_rows': rows.total,
+            'mean_rows': rows.mean(),
+            'p95_rows': int(round(rows.quantile(0.95))),
+            'p99_rows': int(round(rows.quantile(0.99))),
+            'max_rows': rows.max,
+        }
+
+
+def count_slow_queries(entries, stats=None):
+    """Collects the SlowQueryStats of the entries of a slow log by
+    fingerprint
+
+    :param entries: iterable of dicts, as yielded by `parse_slow_log`
+    :param stats: dict, to add the stats to [default: None]
+    :rtype: dict of fingerprint -> SlowQueryStats
+
+    """
+    stats = {} if stats is None else stats
+    for entry in entries:
+        fp = fingerprint(entry['query'])
+        try:
+            stats[fp].add(entry)
+        except KeyError:
+            stats[fp] = SlowQueryStats(entry['query'])
+            stats[fp].add(entry)
+    return stats
+
+
+def sorted_slow_stats(stats, n=None):
+    """Fingerprints and their SlowQueryStats, highest total query time
+    first
+
+    :param stats: dict, as returned by `count_slow_queries`
+    :param n: int, to only get the top n [default: None]
+    :rtype: list of (fingerprint, SlowQueryStats) tuples
+
+    """
+    key = lambda x: (-x[1].query_times.total, x[0])
+    if n is not None:
+        return heapq.nsmallest(n, stats.iteritems(), key=key)
+    return sorted(stats.iteritems(), key=key)
+
+
+# Header line of an entry of the general log: the time (only written
+# when it changed, in the 5.1-5.6 or 5.7+ format), the connection id,
+# the command and the first line of its argument
+GENERAL_ENTRY_RE = re.compile(
+    r'(\d{6} [ \d]\d:\d\d:\d\d|\d{4}-\d\d-\d\dT[\d:.]+Z?)?\t\t? *(\d+) '
+    r'([A-Z][a-z]+(?: [A-Za-z]+)?)(?:\t(.*))?$')
+
+# First chars of the header lines, checked before the regex
+HEADER_START = frozenset('\t0123456789')
+
+
+def match_entry(line):
+    """Match of the header of an entry of the general log, or None if
+    the line isn't one (ie. a continuation of a multi-line argument)"""
+    if line[:1] in HEADER_START:
+        return GENERAL_ENTRY_RE.match(line)
     return None
 
 
-def format_query(line):
-    return line.lower().replace('query\t', '').replace('\t', ' ')
+def _general_entry(entry, argument):
+    if len(argument) == 1:
+        entry['argument'] = argument[0].strip()
+    else:
+        entry['argument'] = ''.join(argument).strip()
+    return entry
+
+
+def parse_general_log(lines):
+    """Generator of the entries of a general log, with the lines of
+    multi-line arguments (queries) put back together
+
+    The server writes each entry in one go, so the lines following a
+    header up to the next header belong to its argument. Only the
+    entry being put back together is held in memory and its argument
+    is truncated to MAX_QUERY_SIZE.
+
+    :param lines: iterable of str
+    :rtype: generator of dicts with the time (the last one written),
+            connection (id), command and argument of the entries
+
+    """
+    entry, argument, size = None, [], 0
+    time = None
+    match = GENERAL_ENTRY_RE.match
+    for line in lines:
+        m = match(line) if line[:1] in HEADER_START else None
+        if m is not None:
+            if entry is not None:
+                yield _general_entry(entry, argument)
+            line_time, connection, command, first = m.groups()
+            if line_time:
+                time = line_time
+            entry = {'time': time, 'connection': int(connection),
+                     'command': command}
+            argument = [(first or '')[:MAX_QUERY_SIZE]]
+            size = len(argument[0])
+        elif is_preamble(line):
+            if entry is not None:
+                yield _general_entry(entry, argument)
+            entry, argument, size = None, [], 0
+        elif entry is not None and size < MAX_QUERY_SIZE:
+            if len(argument) == 1:
+                argument.append('\n')
+                size += 1
+            argument.append(line[:MAX_QUERY_SIZE - size])
+            size += len(argument[-1])
+    if entry is not None:
+        yield _general_entry(entry, argument)
+
+
+def is_query(entry):
+    """Whether an entry of the general log is one of the queries that
+    are counted"""
+    return (entry['command'] == 'Query' and
+            entry['argument'][:6].lower() in QUERY_VERBS)
+
+
+class Connection(object):
+    """State of a connection: its user and current database, and the
+    number of queries (as counted by `is_query`) it ran"""
+
+    __slots__ = ('id', 'user', 'db', 'queries', 'closed', 'dbs')
+
+    def __init__(self, id, user=None, db=None):
+        self.id = id
+        self.user = user
+        self.db = db
+        self.queries = 0
+        self.closed = False
+        # databases the connection ran queries in, while it's open
+        self.dbs = set()
+
+
+def parse_connect(argument):
+    """User and database of the argument of Connect and Change user
+    entries, eg. `root@localhost on shop using Socket`"""
+    user, _, rest = argument.partition(' on ')
+    db = rest.split(' using ', 1)[0].strip() or None
+    return user.strip() or None, db
+
+
+def track_connections(entries, connections=None):
+    """Generator that follows the state of the connections through the
+    entries of a general log (Connect, Init DB, USE queries, Change user
+    and Quit), yielding each entry along with its Connection
+
+    Connections already open when the log starts are created when
+    first seen, with an unknown user. A connection is dropped when its
+    Quit is seen, so only the open ones are held in memory.
+
+    :param entries: iterable of dicts, as yielded by `parse_general_log`
+    :param connections: dict of id -> Connection, to keep the open
+                        connections in [default: None]
+    :rtype: generator of (entry, Connection) tuples
+
+    """
+    connections = {} if connections is None else connections
+    for entry in entries:
+        command, argument = entry['command'], entry['argument']
+        conn = connections.get(entry['connection'])
+        if conn is None:
+            conn = connections[entry['connection']] = \
+                Connection(entry['connection'])
+        if command in ('Connect', 'Change user'):
+            conn.user, conn.db = parse_connect(argument)
+        elif command == 'Init DB':
+            conn.db = argument or None
+        elif command == 'Query':
+            if argument[:4].lower() == 'use ':
+                conn.db = argument[4:].strip().rstrip(';').strip('`')
+        elif command == 'Quit':
+            conn.closed = True
+            del connections[conn.id]
+        yield entry, conn
+
+
+def count_lines(lines):
+    """Counts the queries in lines of the general log by fingerprint"""
+    return count_fingerprints(e['argument'] for e in parse_general_log(lines)
+                              if is_query(e))
+
+
+def _entry_tail(filepath, end):
+    """Lines of a file from `end` up to the next entry header, the end
+    of an entry that started before `end`"""
+    with open(filepath, 'rb') as f:
+        f.seek(end)
+        for line in f:
+            if match_entry(line) is not None:
+                return
+            yield line
+
+
+def count_range(task):
+    """Counts the queries in a byte range of a file. Runs in the worker
+    processes of `parallel_count`. The entries are those whose header
+    is in the range, so the lines before the first header belong to
+    the previous range and the range goes on until the next header
+
+    :param task: tuple of (filepath, start, end). If start and end are
+                 None, the complete file is read
+    :rtype: dict, as returned by `count_fingerprints`
+
+    """
+    filepath, start, end = task
+    if start is None:
+        with cli.read_input(filepath, False) as lines:
+            return count_lines(lines)
+    lines = cli.read_range(filepath, start, end)
+    if start > 0:
+        lines = itertools.dropwhile(lambda l: match_entry(l) is None, lines)
+    return count_lines(itertools.chain(lines, _entry_tail(filepath, end)))
+
+
+def count_connections(lines, n=None):
+    """Counts the queries of the general log per connection and per
+    database
+
+    The open connections are tracked by `track_connections`, a closed
+    one only counts once it's finished. With `n`, only the n finished
+    connections with the most queries are kept, so memory use doesn't
+    grow with the number of connections in the log.
+
+    :param lines: iterable of str
+    :param n: int, number of connections to keep [default: None]
+    :rtype: tuple of (list of Connections, including the closed ones
+            whose id was reused, dict of database -> [queries,
+            connections])
+
+    """
+    finished, databases, open_conns = [], {}, {}
+    key = lambda c: (c.queries, -c.id)
+
+    def finish(conn):
+        conn.dbs = None
+        if n is None:
+            finished.append(conn)
+        elif len(finished) < n:
+            heapq.heappush(finished, (key(conn), len(finished), conn))
+        elif key(conn) > finished[0][0]:
+            heapq.heapreplace(finished, (key(conn), finished[0][1], conn))
+
+    for entry, conn in track_connections(parse_general_log(lines),
+                                         open_conns):
+        if is_query(entry):
+            conn.queries += 1
+            try:
+                db = databases[conn.db]
+            except KeyError:
+                db = databases[conn.db] = [0, 0]
+            db[0] += 1
+            if conn.db not in conn.dbs:
+                conn.dbs.add(conn.db)
+                db[1] += 1
+        if conn.closed:
+            finish(conn)
+    for conn in open_conns.itervalues():
+        finish(conn)
+    if n is not None:
+        finished = [conn for _, _, conn in finished]
+    return finished, databases
+
+
+def parallel_count(filepaths, jobs, chunk_size=CHUNK_SIZE):
+    """Counts the queries in files by fingerprint using a pool of
+    `jobs` processes, each working on newline aligned byte ranges of
+    the files. Compressed files can't be split into ranges so each of
+    them is read by a single process. The counts of the ranges are
+    merged in order, so the result is the same as that of a single
+    process
+
+    :param filepaths: str or list of str
+    :param jobs: int, number of processes
+    :param chunk_size: int
+    :rtype: dict, as returned by `count_fingerprints`
+
+    """
+    tasks = []
+    for filepath in cli.expand_paths(filepaths):
+        if cli.compression(filepath) is not None:
+            tasks.append((filepath, None, None))
+        else:
+            tasks.extend((filepath, start, end)
+                         for start, end in cli.byte_ranges(filepath,
+                                                           chunk_size))
+    counts = {}
+    if jobs == 1:
+        for task in tasks:
+            merge_counts(counts, count_range(task))
+        return counts
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for range_counts in pool.imap(count_range, tasks):
+            merge_counts(counts, range_counts)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return counts
 
 
 def aggregate(queries):
@@ -25,8 +588,7 @@ def aggregate(queries):
     return new_agg
 
 
-def as_html(queries):
-    return """<!DOCTYPE html>
+HTML_HEAD = """<!DOCTYPE html>
 <html>
   <head>
     <style type="text/css">
@@ -35,29 +597,559 @@ def as_html(queries):
   </head>
   <body>
     <div class="container">
-      <h1>Mysql General log analysis at {date}</h1>
+      <h1>Mysql {log} log analysis at {date}</h1>
+      {nav}
       <table>
-         {rows}
-      </table>
+"""
+
+HTML_TAIL = """      </table>
+      {nav}
     </div>
   </body>
 </html>
-""".format(css='.container { width: 1200px; } table { width: 100%; border: 1px solid #ddd; table-layout: fixed; word-wrap: break-word; } td { width: 90%; border: 1px solid #ddd; border-collapse: collapse; } td+td { width: 9%; }',
-           date=str(datetime.datetime.now()),
-           rows='\n'.join(['<tr><td>%s</td><td>%s</td></tr>' % (q, c) for c, q in queries]))
+"""
+
+CSS = '.container { width: 1200px; } table { width: 100%; border: 1px solid #ddd; table-layout: fixed; word-wrap: break-word; } td { width: 90%; border: 1px solid #ddd; border-collapse: collapse; } td+td { width: 9%; }'
+
+SLOW_CSS = '.container { width: 1200px; } table { width: 100%; border: 1px solid #ddd; table-layout: fixed; word-wrap: break-word; } td, th { width: 7%; border: 1px solid #ddd; border-collapse: collapse; } td:first-child, th:first-child { width: 37%; }'
+
+# Rows rendered and written at a time
+RENDER_CHUNK = 1000
+
+# Columns of the reports. The rows of a report are lists of values of
+# the columns, the fingerprint first and the sample query last
+GENERAL_COLUMNS = ['fingerprint', 'count', 'sample']
+
+# Keys of `SlowQueryStats.summary` in the slow log reports
+SLOW_COLUMNS = ['count', 'total_time', 'mean_time', 'p95_time', 'p99_time',
+                'mean_rows', 'p95_rows', 'p99_rows']
+
+
+def general_rows(queries):
+    """Report rows of (count, fingerprint, sample) tuples"""
+    for c, fp, sample in queries:
+        yield [fp, c, sample]
+
+
+# Columns of the reports per connection and per database
+CONNECTION_COLUMNS = ['connection', 'user', 'db', 'queries']
+DATABASE_COLUMNS = ['database', 'queries', 'connections']
+
+
+def connection_rows(connections, n=None):
+    """Report rows of the connections, most queries first"""
+    key = lambda c: (-c.queries, c.id)
+    if n is not None:
+        conns = heapq.nsmallest(n, connections, key=key)
+    else:
+        conns = sorted(connections, key=key)
+    for c in conns:
+        yield [str(c.id), c.user or '-', c.db or '-', c.queries]
+
+
+def database_rows(databases, n=None):
+    """Report rows of the databases, most queries first"""
+    key = lambda x: (-x[1][0], x[0])
+    if n is not None:
+        dbs = heapq.nsmallest(n, databases.iteritems(), key=key)
+    else:
+        dbs = sorted(databases.iteritems(), key=key)
+    for db, (queries, conns) in dbs:
+        yield [db or '-', queries, conns]
+
+
+def slow_rows(stats):
+    """Report rows of (fingerprint, SlowQueryStats) tuples"""
+    for fp, s in stats:
+        summary = s.summary()
+        yield [fp] + [summary[c] for c in SLOW_COLUMNS] + [s.sample]
+
+
+def format_number(value):
+    if isinstance(value, float):
+        return '%.6f' % (value,) if value < 1 else '%.2f' % (value,)
+    return str(value)
+
+
+def chunks(rows, size=RENDER_CHUNK):
+    """Splits an iterable into lists of at most `size` items"""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def escape(text):
+    """cgi.escape, skipped for the (most) queries without & < >"""
+    if '&' in text or '<' in text or '>' in text:
+        return cgi.escape(text)
+    return text
+
+
+def _html_row(row):
+    return '<tr><td>%s<br><small>eg. %s</small></td>%s</tr>\n' % (
+        escape(row[0]), escape(row[-1]),
+        ''.join(['<td>%s</td>' % (format_number(v),) for v in row[1:-1]]))
+
+
+def _plain_html_row(row):
+    return '<tr>%s</tr>\n' % (''.join(['<td>%s</td>' % (
+        escape(format_number(v)),) for v in row]),)
+
+
+def write_html(columns, rows, out, log='General', css=CSS, nav='',
+               sampled=False):
+    """Writes a report as an html page, RENDER_CHUNK rows at a time
+
+    :param columns: list of str
+    :param rows: iterable of lists
+    :param out: file like object
+    :param log: str, type of the log for the title
+    :param css: str
+    :param nav: str, html of the links to the other pages
+    :param sampled: bool, whether the first and last columns are the
+                    fingerprint and a sample query, shown together
+    :rtype: None
+
+    """
+    out.write(HTML_HEAD.format(css=css, log=log, nav=nav,
+                               date=str(datetime.datetime.now())))
+    if sampled:
+        out.write('<tr><th>query</th>%s</tr>\n' % (
+            ''.join('<th>%s</th>' % (c,) for c in columns[1:-1]),))
+    else:
+        out.write('<tr>%s</tr>\n' % (
+            ''.join('<th>%s</th>' % (c,) for c in columns),))
+    render = _html_row if sampled else _plain_html_row
+    for chunk in chunks(rows):
+        out.write(''.join(render(row) for row in chunk))
+    out.write(HTML_TAIL.format(nav=nav))
+
+
+def page_name(page):
+    return 'index.html' if page == 1 else 'page%d.html' % (page,)
+
+
+def write_html_pages(columns, rows, dirpath, page_size, log='General',
+                     css=CSS, sampled=False):
+    """Writes a report as html pages of `page_size` rows linked to each
+    other, index.html being the first one. Only two pages of rows are
+    held in memory at a time
+
+    :param columns: list of str
+    :param rows: iterable of lists
+    :param dirpath: str, directory to write the pages to
+    :param page_size: int
+    :param log: str, type of the log for the title
+    :param css: str
+    :param sampled: bool, as for `write_html`
+    :rtype: int, number of pages
+
+    """
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+    pages = chunks(rows, page_size)
+    page, current = 1, next(pages, [])
+    while True:
+        following = next(pages, None)
+        links = ['page %d' % (page,)]
+        if page > 1:
+            links.insert(0, '<a href="%s">previous</a>' % (page_name(page - 1),))
+        if following is not None:
+            links.append('<a href="%s">next</a>' % (page_name(page + 1),))
+        with open(os.path.join(dirpath, page_name(page)), 'w') as f:
+            write_html(columns, current, f, log, css,
+                       '<p>%s</p>' % (' | '.join(links),), sampled)
+        if following is None:
+            return page
+        page, current = page + 1, following
+
+
+def write_txt(columns, rows, out, sampled=False):
+    """Writes a report as lines of `fingerprint -> values`, without the
+    sample queries of the `sampled` reports (see `write_html`)"""
+    names = columns[1:-1] if sampled else columns[1:]
+    for chunk in chunks(rows):
+        if len(names) == 1:
+            lines = ['%s -> %s\n' % (row[0], format_number(row[1]))
+                     for row in chunk]
+        else:
+            lines = ['%s -> %s\n' % (row[0], ', '.join(
+                '%s=%s' % (c, format_number(v))
+                for c, v in zip(names, row[1:])))
+                for row in chunk]
+        out.write(''.join(lines))
+
+
+def write_csv(columns, rows, out):
+    """Writes a report as csv with a header line"""
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for chunk in chunks(rows):
+        writer.writerows(chunk)
+
+
+def write_json(columns, rows, out):
+    """Writes a report as a json array of objects, one per line"""
+    out.write('[')
+    first = True
+    for chunk in chunks(rows):
+        encoded = [json.dumps(dict(zip(columns, row))) for row in chunk]
+        out.write(('\n' if first else ',\n') + ',\n'.join(encoded))
+        first = False
+    out.write('\n]\n')
+
+
+WRITERS = {
+    'html': write_html,
+    'txt': write_txt,
+    'csv': write_csv,
+    'json': write_json,
+}
+
+
+def as_html(queries):
+    out = io.BytesIO()
+    write_html(GENERAL_COLUMNS, general_rows(queries), out, sampled=True)
+    return out.getvalue()
 
 
 def as_txt(queries):
-    return ['%s -> %d' % (q, c) for q, c in queries]
+    out = io.BytesIO()
+    write_txt(GENERAL_COLUMNS, general_rows(queries), out, True)
+    return out.getvalue().splitlines()
+
+
+def slow_as_html(stats):
+    out = io.BytesIO()
+    write_html(['fingerprint'] + SLOW_COLUMNS + ['sample'], slow_rows(stats),
+               out, 'Slow query', SLOW_CSS, sampled=True)
+    return out.getvalue()
+
+
+def slow_as_txt(stats):
+    out = io.BytesIO()
+    write_txt(['fingerprint'] + SLOW_COLUMNS + ['sample'], slow_rows(stats),
+              out, True)
+    return out.getvalue().splitlines()
+
+
+def test():
+    """Tests (Use nosetests to run them)"""
+    assert fingerprint("SELECT * FROM users WHERE id=1") == \
+        fingerprint("select *  from users\n where id = 2") == \
+        'select * from users where id = ?'
+    assert fingerprint("SELECT name FROM t1 WHERE name = 'it''s' "
+                       "AND x = \"a\\\"b\" AND y=-1.5e3 AND z=0x1F") == \
+        'select name from t1 where name = ? and x = ? and y = ? and z = ?'
+    assert fingerprint('SELECT * FROM t WHERE x = -1 AND y IN (-2, 3) '
+                       'AND z > -4.5 AND w = a - 1') == \
+        fingerprint('select * from t where x = 1 and y in (2) and z > 4 '
+                    'and w = a - 7') == \
+        'select * from t where x = ? and y in (?+) and z > ? and w = a - ?'
+    assert fingerprint('DELETE FROM t WHERE id IN (74, 375,376)') == \
+        fingerprint('delete from t where id in(1)') == \
+        'delete from t where id in (?+)'
+    assert fingerprint("INSERT INTO t (a, b) VALUES (1, 'x'), (2, NOW()) "
+                       "/* batch */") == \
+        'insert into t (a, b) values (?+)'
+    assert fingerprint('INSERT INTO t VALUES (1) ON DUPLICATE KEY UPDATE '
+                       'a = 2') == \
+        'insert into t values (?+) on duplicate key update a = ?'
+    assert fingerprint('SELECT `col1` FROM db2.t3 LIMIT 10, 20') == \
+        'select `col1` from db2.t3 limit ?, ?'
+    assert fingerprint("SELECT doc->'$.a', doc->>'$.b', 1<<2, @v:=3 "
+                       "FROM t WHERE a<>b") == \
+        'select doc -> ?, doc ->> ?, ? << ?, @v := ? from t where a <> b'
+    assert fingerprint('SELECT a FROM t WHERE a<=>b OR a<>b OR a>=1 '
+                       'OR a != 2 OR a <= 3 -- done') == \
+        'select a from t where a <=> b or a <> b or a >= ? or a != ? ' \
+        'or a <= ?'
+    assert fingerprint("SELECT * FROM t WHERE url = 'http://x/#a' "
+                       "AND id = 5 # last") == \
+        'select * from t where url = ? and id = ?'
+    assert fingerprint("UPDATE t SET note = 'a -- b' WHERE id = 3") == \
+        'update t set note = ? where id = ?'
+    assert fingerprint("SELECT a--1 /* it's */ FROM t WHERE b = 'x'") == \
+        'select a--? from t where b = ?'
+
+    lines = ['\t\t   57 Query\tSELECT * FROM t WHERE id = 72\n',
+             '121108 10:00:01\t   57 Query\tselect * from t where id = 5\n',
+             '\t\t   57 Connect\troot@localhost on db\n',
+             "\t\t   58 Query\tUPDATE t SET a = 'b' WHERE id = 3\n"]
+    queries = [e['argument'] for e in parse_general_log(lines)
+               if is_query(e)]
+    agg = aggregate_fingerprints(queries)
+    assert agg == [(2, 'select * from t where id = ?',
+                    'SELECT * FROM t WHERE id = 72'),
+                   (1, 'update t set a = ? where id = ?',
+                    "UPDATE t SET a = 'b' WHERE id = 3")]
+    assert as_txt(agg)[0] == 'select * from t where id = ? -> 2'
+    assert '<td>2</td>' in as_html(agg)
+    assert [is_query(e) for e in parse_general_log([
+        '\t\t   57 Query\tselect 1', '\t\t   57 Query\tSHOW TABLES\n'])] == \
+        [True, False]
+
+    general_log = """/usr/sbin/mysqld, Version: 5.5.28-log (MySQL Community Server). started with:
+Tcp port: 3306  Unix socket: /var/run/mysqld/mysqld.sock
+Time                 Id Command    Argument
+121108 10:00:01\t    7 Connect\tapp@localhost on shop
+\t\t    7 Query\tSELECT *
+FROM orders
+WHERE id = 1
+\t\t    8 Query\tselect 1 from dual
+\t\t    7 Init DB\tblog
+121108 10:00:02\t    7 Query\tSELECT *
+\tFROM posts WHERE id = 2
+\t\t    7 Quit\t
+\t\t    7 Connect\troot@localhost on  using Socket
+\t\t    7 Query\tuse shop
+\t\t    7 Query\tdelete from orders
+\t\t    7 Quit\t
+"""
+    general_lines = general_log.splitlines(True)
+    entries = list(parse_general_log(general_lines))
+    assert [e['command'] for e in entries] == [
+        'Connect', 'Query', 'Query', 'Init DB', 'Query', 'Quit', 'Connect',
+        'Query', 'Query', 'Quit']
+    assert entries[1]['argument'] == 'SELECT *\nFROM orders\nWHERE id = 1'
+    assert entries[4]['argument'] == 'SELECT *\n\tFROM posts WHERE id = 2'
+    assert entries[4]['time'] == '121108 10:00:02'
+    assert entries[5]['argument'] == ''
+    tracked = [(e['command'], c.user, c.db)
+               for e, c in track_connections(entries)]
+    assert tracked[4] == ('Query', 'app@localhost', 'blog')
+    assert tracked[7] == ('Query', 'root@localhost', 'shop')
+    assert tracked[2] == ('Query', None, None)
+    assert parse_connect('a@h on db using TCP/IP') == ('a@h', 'db')
+    connections, databases = count_connections(general_lines)
+    assert sorted(databases.items()) == [
+        (None, [1, 1]), ('blog', [1, 1]), ('shop', [2, 2])]
+    assert len(connections) == 3 and all(c.closed for c in connections
+                                         if c.id == 7)
+    assert list(database_rows(databases, 1)) == [['shop', 2, 2]]
+    assert list(connection_rows(connections)) == [
+        ['7', 'app@localhost', 'blog', 2], ['7', 'root@localhost', 'shop', 1],
+        ['8', '-', '-', 1]]
+    top_connections, _ = count_connections(general_lines, 2)
+    assert list(connection_rows(top_connections)) == [
+        ['7', 'app@localhost', 'blog', 2], ['7', 'root@localhost', 'shop', 1]]
+    open_conns = {}
+    for _ in track_connections(entries, open_conns):
+        pass
+    assert open_conns.keys() == [8]
+    out = io.BytesIO()
+    write_txt(DATABASE_COLUMNS, database_rows(databases), out)
+    assert out.getvalue().splitlines()[0] == 'shop -> queries=2, connections=2'
+    out = io.BytesIO()
+    write_html(CONNECTION_COLUMNS, connection_rows(connections), out)
+    assert '<tr><td>7</td><td>root@localhost</td>' in out.getvalue()
+    assert sorted(count_lines(general_lines)) == [
+        'delete from orders', 'select * from orders where id = ?',
+        'select * from posts where id = ?', 'select ? from dual']
+    entry, = parse_general_log(['\t\t    9 Query\tselect\n',
+                                "'/opt/mysqld, Version: 5' as v\n"])
+    assert entry['argument'] == "select\n'/opt/mysqld, Version: 5' as v"
+    assert is_preamble(general_lines[0])
+    long_query = ['\t\t    9 Query\tselect\n'] + ['x' * 1000 + '\n'] * 2000
+    entry, = parse_general_log(long_query)
+    assert len(entry['argument']) <= MAX_QUERY_SIZE
+
+    slow_log = """/usr/sbin/mysqld, Version: 5.5.28-log (MySQL Community Server). started with:
+Tcp port: 3306  Unix socket: /var/run/mysqld/mysqld.sock
+Time                 Id Command    Argument
+# Time: 121108 10:00:01
+# User@Host: root[root] @ localhost []
+# Query_time: 2.500000  Lock_time: 0.000100 Rows_sent: 1  Rows_examined: 5000
+use shop;
+SET timestamp=1352368801;
+SELECT *
+FROM orders
+WHERE id = 12;
+# User@Host: root[root] @ localhost []
+# Query_time: 0.500000  Lock_time: 0.000000 Rows_sent: 1  Rows_examined: 1000
+SET timestamp=1352368801;
+select * from orders where id = 13;
+# Time: 121108 10:00:02
+# User@Host: root[root] @ localhost []
+# Query_time: 1.000000  Lock_time: 0.000200 Rows_sent: 0  Rows_examined: 10
+SET timestamp=1352368802;
+UPDATE orders SET state = 'x'
+  WHERE id IN (1, 2);
+"""
+    entries = list(parse_slow_log(slow_log.splitlines(True)))
+    assert [e['query_time'] for e in entries] == [2.5, 0.5, 1.0]
+    assert entries[0]['query'] == 'SELECT *\nFROM orders\nWHERE id = 12'
+    assert entries[0]['db'] == entries[2]['db'] == 'shop'
+    assert entries[2]['rows_examined'] == 10
+    slow = sorted_slow_stats(count_slow_queries(entries))
+    assert [fp for fp, _ in slow] == [
+        'select * from orders where id = ?',
+        'update orders set state = ? where id in (?+)']
+    summary = slow[0][1].summary()
+    assert summary['count'] == 2 and summary['total_time'] == 3.0
+    assert summary['mean_time'] == 1.5 and summary['total_rows'] == 6000
+    assert summary['max_time'] == 2.5 and summary['max_rows'] == 5000
+    assert slow[0][1].sample.startswith('SELECT *\nFROM')
+    assert slow_as_txt(slow)[1].startswith(
+        'update orders set state = ? where id in (?+) -> count=1, '
+        'total_time=1.00')
+    assert '<th>p99_time</th>' in slow_as_html(slow)
+    assert escape('a < b & c') == 'a &lt; b &amp; c'
+
+    import os
+    import gzip
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(tmpdir, 'mysql.log')
+        with open(plain, 'w') as f:
+            f.writelines(lines * 50)
+        compressed = os.path.join(tmpdir, 'mysql.log.1.gz')
+        with gzip.open(compressed, 'wb') as f:
+            f.writelines(lines * 10)
+        expected = count_lines(lines * 60)
+        assert parallel_count([plain, compressed], 1, 100) == expected
+        assert parallel_count(os.path.join(tmpdir, '*'), 2, 100) == expected
+        multi = os.path.join(tmpdir, 'multi.log')
+        with open(multi, 'w') as f:
+            f.writelines(general_lines * 20)
+        expected = count_lines(general_lines * 20)
+        assert parallel_count(multi, 1, 37) == expected
+        assert parallel_count(multi, 1, 10 ** 6) == expected
+
+        counts = dict(('select %d' % (i,), [i, 'SELECT %d' % (i,)])
+                      for i in range(1, 2501))
+        top = sorted_counts(counts, 3)
+        assert top == list(sorted_counts(counts))[:3]
+        assert [c for c, _, _ in top] == [2500, 2499, 2498]
+        out = io.BytesIO()
+        write_csv(GENERAL_COLUMNS, general_rows(top), out)
+        assert out.getvalue().splitlines()[:2] == [
+            'fingerprint,count,sample', 'select 2500,2500,SELECT 2500']
+        out = io.BytesIO()
+        write_json(GENERAL_COLUMNS, general_rows(sorted_counts(counts)), out)
+        rows = json.loads(out.getvalue())
+        assert len(rows) == 2500 and rows[-1]['count'] == 1
+        out = io.BytesIO()
+        write_json(GENERAL_COLUMNS, [], out)
+        assert json.loads(out.getvalue()) == []
+        out = io.BytesIO()
+        write_txt(GENERAL_COLUMNS, general_rows(top), out, True)
+        assert out.getvalue().splitlines()[0] == 'select 2500 -> 2500'
+        pages = os.path.join(tmpdir, 'report')
+        assert write_html_pages(GENERAL_COLUMNS,
+                                general_rows(sorted_counts(counts)),
+                                pages, 1000, sampled=True) == 3
+        assert sorted(os.listdir(pages)) == ['index.html', 'page2.html',
+                                             'page3.html']
+        with open(os.path.join(pages, 'page2.html')) as f:
+            page = f.read()
+        assert page.count('<tr><td>') == 1000
+        assert 'href="index.html">previous' in page
+        assert 'href="page3.html">next' in page
+        with open(os.path.join(pages, 'page3.html')) as f:
+            assert 'next</a>' not in f.read()
+    finally:
+        shutil.rmtree(tmpdir)
 
 
 if __name__ == '__main__':
-    with open('/home/vineet/errorlogs/mysql/mysql.log') as f:
-        queries = (format_query(q) for 
-                   q in (match_query(line) for line in f)
-                   if q is not None)
-        agg = aggregate(queries)
-    print as_html(agg)
-    
-        
+    parser = argparse.ArgumentParser(
+        description=(
+            'Counts the queries of mysql general logs, or sums up '
+            'the query times of slow query logs, by fingerprint'
+        ))
+    parser.add_argument('-t', '--log-type', default='general',
+                        choices=['general', 'slow'],
+                        help='Type of the mysql log')
+    parser.add_argument('-b', '--by', default='fingerprint',
+                        choices=['fingerprint', 'connection', 'database'],
+                        help=(
+                            'Count the queries of a general log by '
+                            'fingerprint, connection or database. Only '
+                            'fingerprints are counted in parallel'
+                        ))
+    parser.add_argument('-f', '--filepath', nargs='+',
+                        help=(
+                            'path to the log file, multiple paths and '
+                            'glob patterns are counted together and '
+                            'gzip, bz2 and xz files are decompressed'
+                        ))
+    parser.add_argument('-i', '--stdin',
+                        help='Use standard input', action='store_true')
+    parser.add_argument('-o', '--output-format',
+                        choices=sorted(WRITERS.keys()),
+                        help='Output format of the report, html by default')
+    parser.add_argument('-w', '--output-file',
+                        help='File to write the report to, stdout if absent')
+    parser.add_argument('-n', '--top', type=int,
+                        help='Only report the top n fingerprints')
+    parser.add_argument('-d', '--output-dir',
+                        help=(
+                            'Directory to write the html report to, '
+                            'split in pages of --page-size fingerprints'
+                        ))
+    parser.add_argument('--page-size', type=int, default=500,
+                        help='Fingerprints per page with --output-dir')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help=(
+                            'Number of processes to use for reading '
+                            'the files in parallel (general logs only)'
+                        ))
+    args = parser.parse_args()
+    if args.output_dir and (args.output_file or
+                            args.output_format not in (None, 'html')):
+        parser.error('--output-dir writes html pages, it can\'t be used '
+                     'with --output-file or another --output-format')
+    args.output_format = args.output_format or 'html'
+
+    try:
+        if args.log_type == 'slow':
+            with cli.read_input(args.filepath, args.stdin) as f:
+                stats = count_slow_queries(parse_slow_log(f))
+            columns = ['fingerprint'] + SLOW_COLUMNS + ['sample']
+            rows = slow_rows(sorted_slow_stats(stats, args.top))
+            log, css, sampled = 'Slow query', SLOW_CSS, True
+        elif args.by != 'fingerprint':
+            with cli.read_input(args.filepath, args.stdin) as f:
+                connections, databases = count_connections(
+                    f, args.top if args.by == 'connection' else None)
+            if args.by == 'connection':
+                columns = CONNECTION_COLUMNS
+                rows = connection_rows(connections, args.top)
+            else:
+                columns = DATABASE_COLUMNS
+                rows = database_rows(databases, args.top)
+            log, css, sampled = 'General', SLOW_CSS, False
+        else:
+            if args.filepath:
+                counts = parallel_count(args.filepath, args.jobs)
+            else:
+                with cli.read_input(None, args.stdin) as f:
+                    counts = count_lines(f)
+            columns = GENERAL_COLUMNS
+            rows = general_rows(sorted_counts(counts, args.top))
+            log, css, sampled = 'General', CSS, True
+    except cli.CliError as e:
+        sys.exit(str(e))
 
+    if args.output_dir:
+        pages = write_html_pages(columns, rows, args.output_dir,
+                                 args.page_size, log, css, sampled)
+        print 'Wrote %d pages to %s' % (pages, args.output_dir)
+    else:
+        out = open(args.output_file, 'w') if args.output_file else sys.stdout
+        try:
+            if args.output_format == 'html':
+                write_html(columns, rows, out, log, css, sampled=sampled)
+            elif args.output_format == 'txt':
+                write_txt(columns, rows, out, sampled)
+            else:
+                WRITERS[args.output_format](columns, rows, out)
+        finally:
+            if args.output_file:
+                out.close()
@@ -0,0 +1,301 @@
+"""Small, mergeable summaries of streams of values
+
+These keep a bounded amount of memory however many values are added,
+and two of them built over different parts of a stream (other files,
+other processes) can be merged into the summary of the whole stream.
+
+"""
+
+import math
+import heapq
+
+
+class QuantileSketch(object):
+    """Sketch for estimating quantiles of non negative values
+
+    Values are counted in buckets whose bounds grow geometrically, so
+    that any quantile is estimated within `relative_accuracy` of the
+    actual value (as in DDSketch). Values <= 0 are counted apart. If
+    the number of buckets goes beyond `max_buckets`, the lowest ones
+    are merged, which only affects the accuracy of the lowest
+    quantiles. Since the buckets only depend on the values, merging
+    sketches gives the same result as adding all the values to one.
+
+    :param relative_accuracy: float
+    :param max_buckets: int
+
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=1024):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, n=1):
+        """Adds a value n times"""
+        self.count += n
+        self.total += value * n
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zero_count += n
+            return
+        index = int(math.ceil(math.log(value) / self.log_gamma))
+        try:
+            self.buckets[index] += n
+        except KeyError:
+            self.buckets[index] = n
+            if len(self.buckets) > self.max_buckets:
+                self._collapse()
+
+    def _collapse(self):
+        """Merges the lowest buckets into the lowest one that's kept"""
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.max_buckets
+        if excess <= 0:
+            return
+        moved = sum(self.buckets.pop(i) for i in indexes[:excess])
+        self.buckets[indexes[excess]] += moved
+
+    def merge(self, other):
+        """Adds the values counted by another sketch to this one"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Sketches with different accuracy')
+        self.count += other.count
+        self.total += other.total
+        self.zero_count += other.zero_count
+        for attr, pick in (('min', min), ('max', max)):
+            values = [v for v in (getattr(self, attr), getattr(other, attr))
+                      if v is not None]
+            setattr(self, attr, pick(values) if values else None)
+        for index, n in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        self._collapse()
+
+    def quantile(self, q):
+        """Estimates the value at quantile q (0 <= q <= 1)
+
+        :param q: float
+        :rtype: float or None if no value has been added
+
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return max(self.min, 0)
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return float(self.total) / self.count if self.count else None
+
+    def to_dict(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'max_buckets': self.max_buckets,
+            'buckets': [[i, n] for i, n in sorted(self.buckets.iteritems())],
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['relative_accuracy'], data['max_buckets'])
+        sketch.buckets = dict((i, n) for i, n in data['buckets'])
+        for attr in ('zero_count', 'count', 'total', 'min', 'max'):
+            setattr(sketch, attr, data[attr])
+        return sketch
+
+
+class SpaceSaving(object):
+    """Approximate counts of the most frequent keys of a stream, in a
+    fixed number of counters (Space-Saving algorithm)
+
+    When all the counters are used, the key with the lowest count is
+    evicted for the new one, which takes over its count, recorded as
+    the error of the new key. So a count is never lower than the
+    actual one and never higher by more than its error, itself at most
+    total / capacity. Any key more frequent than that is kept.
+
+    :param capacity: int, number of counters
+
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        # (count, key) of every key, possibly with an outdated count
+        # which is only fixed when it gets to the top
+        self._heap = []
+
+    def add(self, key, n=1):
+        """Counts a key n times"""
+        self.total += n
+        if key in self.counts:
+            self.counts[key] += n
+            return
+        error = 0
+        if len(self.counts) >= self.capacity:
+            error = self._evict()
+        self.counts[key] = error + n
+        self.errors[key] = error
+        heapq.heappush(self._heap, (error + n, key))
+
+    def _evict(self):
+        """Removes the key with the lowest count and returns its count"""
+        while True:
+            count, key = self._heap[0]
+            if self.counts[key] == count:
+                heapq.heappop(self._heap)
+                del self.counts[key]
+                del self.errors[key]
+                return count
+            heapq.heapreplace(self._heap, (self.counts[key], key))
+
+    def min_count(self):
+        """Count a key that's not kept may have, 0 until all the
+        counters are used"""
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.itervalues())
+
+    def merge(self, other):
+        """Adds the keys counted by another sketch to this one, keeping
+        the same guarantees (as in Agarwal et al., Mergeable
+        Summaries)"""
+        mins = self.min_count(), other.min_count()
+        counts, errors = {}, {}
+        for key in set(self.counts) | set(other.counts):
+            counts[key] = (self.counts.get(key, mins[0]) +
+                           other.counts.get(key, mins[1]))
+            errors[key] = (self.errors.get(key, mins[0]) +
+                           other.errors.get(key, mins[1]))
+        kept = sorted(counts, key=lambda k: (-counts[k], k))[:self.capacity]
+        self.counts = dict((k, counts[k]) for k in kept)
+        self.errors = dict((k, errors[k]) for k in kept)
+        self.total += other.total
+        self._heap = [(c, k) for k, c in self.counts.iteritems()]
+        heapq.heapify(self._heap)
+
+    def top(self, k=None):
+        """Most frequent keys, most frequent first
+
+        :param k: int, number of keys, all if None
+        :rtype: list of (key, count, error) tuples, where the actual
+                count is between count - error and count
+
+        """
+        keys = sorted(self.counts, key=lambda x: (-self.counts[x], x))
+        return [(key, self.counts[key], self.errors[key])
+                for key in keys[:k]]
+
+    def guaranteed(self, k):
+        """Number of keys among the `top(k)` that are surely in the
+        actual top k, ie. whose lowest possible count is higher than
+        the count of any key after them
+
+        :param k: int
+        :rtype: int
+
+        """
+        top = self.top(k + 1)
+        for i, (_, count, error) in enumerate(top[:k]):
+            others = [c for _, c, _ in top[i + 1:]] + [self.min_count()]
+            if count - error < max(others):
+                return i
+        return len(top[:k])
+
+    def to_dict(self):
+        return {
+            'capacity': self.capacity,
+            'total': self.total,
+            'counts': [[k, self.counts[k], self.errors[k]]
+                       for k in sorted(self.counts)],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['capacity'])
+        sketch.total = data['total']
+        for key, count, error in data['counts']:
+            if isinstance(key, list):
+                key = tuple(key)
+            sketch.counts[key] = count
+            sketch.errors[key] = error
+        sketch._heap = [(c, k) for k, c in sketch.counts.iteritems()]
+        heapq.heapify(sketch._heap)
+        return sketch
+
+
+def test():
+    """Tests (Use nosetests to run them)"""
+    import random
+    rnd = random.Random(0)
+    values = [int(rnd.expovariate(1.0 / 5000)) for _ in xrange(10000)] + [0] * 50
+    whole = QuantileSketch()
+    parts = [QuantileSketch(), QuantileSketch()]
+    for i, v in enumerate(values):
+        whole.add(v)
+        parts[i % 2].add(v)
+    parts[0].merge(parts[1])
+    assert parts[0].to_dict() == whole.to_dict()
+    values.sort()
+    for q in (0.5, 0.9, 0.99):
+        actual = values[int(q * (len(values) - 1))]
+        assert abs(whole.quantile(q) - actual) <= 0.011 * actual
+    assert whole.quantile(0) == 0
+    assert whole.quantile(1) == values[-1]
+
+    small = QuantileSketch(max_buckets=10)
+    for v in xrange(1, 1000):
+        small.add(v)
+    assert len(small.buckets) == 10
+    assert abs(small.quantile(0.99) - 989) <= 0.011 * 989
+    copy = QuantileSketch.from_dict(small.to_dict())
+    assert copy.to_dict() == small.to_dict()
+    assert QuantileSketch().quantile(0.5) is None
+
+    from collections import Counter
+    keys = ['hot%d' % (i % 5,) for i in xrange(5000)]
+    keys += ['cold%d' % (rnd.randint(0, 10 ** 6),) for _ in xrange(20000)]
+    rnd.shuffle(keys)
+    actual = Counter(keys)
+    top = SpaceSaving(100)
+    halves = [SpaceSaving(100), SpaceSaving(100)]
+    for i, key in enumerate(keys):
+        top.add(key)
+        halves[i % 2].add(key)
+    assert len(top.counts) == 100 and top.total == len(keys)
+    halves[0].merge(halves[1])
+    for sketch in (top, halves[0]):
+        result = sketch.top(5)
+        assert sorted(k for k, _, _ in result) == sorted(
+            'hot%d' % (i,) for i in range(5))
+        for key, count, error in sketch.top():
+            assert count - error <= actual[key] <= count
+            assert error <= sketch.total / 100
+        assert sketch.guaranteed(5) == 5
+    copy = SpaceSaving.from_dict(top.to_dict())
+    assert copy.top() == top.top()
+    copy.add('hot0')
+    assert copy.counts['hot0'] == top.counts['hot0'] + 1
@@ -4,9 +4,20 @@
 
 """
 
+import os
 import re
+import sys
+import gzip
+import json
+import mmap
+import calendar
+import datetime
 import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import cli
+import log2json
 
 
 LOG_PATTERN_FORMATS = {
@@ -15,6 +26,75 @@ LOG_PATTERN_FORMATS = {
 }
 
 
+# Regexes for extracting the date of a log line, used for
+# partitioning the logs
+LOG_DATE_PATTERNS = {
+    'apache2_access': re.compile(
+        r'^[^\[]*\[(?P<day>\d{2})/(?P<month>[A-Za-z]{3})/(?P<year>\d{4})'
+        r':(?P<hour>\d{2})'
+    ),
+    'apache2_error': re.compile(
+        r'^\[\w+\s(?P<month>[A-Za-z]{3})\s(?P<day>\d{2})\s'
+        r'(?P<hour>\d{2}):\d{2}:\d{2}(\.\d+)?\s(?P<year>\d{4})\]'
+    ),
+}
+
+PARTITION_FORMATS = {
+    'month': '{year}-{month:02d}',
+    'day': '{year}-{month:02d}-{day}',
+    'hour': '{year}-{month:02d}-{day}-{hour}',
+}
+
+MONTHS = dict((m, i) for i, m in enumerate(calendar.month_abbr) if m)
+
+# Key of the partition for the lines at the beginning of the input
+# for which the date can't be found
+UNKNOWN_PARTITION = 'unknown'
+
+# Lines buffered per partition before being written out
+PARTITION_BUFFER_SIZE = 256 * 1024
+
+# Bytes buffered across all the partitions, past which the largest
+# buffer is written out
+MAX_BUFFERED = 32 * 1024 * 1024
+
+# Max number of partition files kept open at the same time
+MAX_OPEN_FILES = 64
+
+# Formats accepted for the --from and --to times, which are in UTC
+TIME_ARG_FORMATS = [
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d',
+    '%d/%b/%Y:%H:%M:%S',
+    '%d/%b/%Y',
+]
+
+# Below this span (in bytes), bisection stops and the lines are
+# scanned one by one
+BISECT_MIN_SPAN = 64 * 1024
+
+# Number of evenly spaced lines checked to find out if a file is
+# ordered by time
+ORDER_PROBES = 64
+
+# Extension of the sidecar time index files
+INDEX_EXT = '.tidx'
+
+# Width of the time buckets of the index in seconds
+INDEX_BUCKET = 60
+
+# Max average number of runs per minute in an index. Past that the log
+# is too far from being ordered by time for the index to be smaller
+# than the log, and it isn't indexed
+INDEX_MAX_RUNS_PER_BUCKET = 16
+
+# Number of runs below which a log is always indexed
+INDEX_MIN_RUNS = 1024
+
+
 def parse_date(date):
     """Extract out day/month/year from the date wildcard pattern as a dict
 
@@ -25,7 +105,7 @@ def parse_date(date):
     """
     day, month, year = date.split('/')
     return dict((('day', '\d{2}' if day == '*' else day),
-                ('month', '[A-Za-z]' if month == '*' else month.title()),
+                ('month', '[A-Za-z]{3}' if month == '*' else month.title()),
                 ('year', '\d{4}' if year == '*' else year)))
 
 
@@ -46,14 +126,597 @@ def split(f, pattern):
     return (line for line in f  if pattern.match(line) is not None)
 
 
-def main(args):
-    pattern = get_date_pattern(parse_date(args.date), args.log_type)
+class PartitionWriter(object):
+    """Writes lines to one file per partition in a directory
+
+    Lines are buffered per partition and the least recently used files
+    are closed when too many are open. The total size of the buffers
+    is bounded too, so memory use doesn't grow with the number of
+    partitions. A file is truncated the first time it's written to and
+    appended to after that.
+
+    :param output_dir: str
+    :param compress: bool, gzip the files
+    :param buffer_size: int, bytes buffered per partition
+    :param max_open: int, max number of open files
+    :param max_buffered: int, bytes buffered across the partitions
+
+    """
+
+    def __init__(self, output_dir, compress=False,
+                 buffer_size=PARTITION_BUFFER_SIZE, max_open=MAX_OPEN_FILES,
+                 max_buffered=MAX_BUFFERED):
+        self.output_dir = output_dir
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.max_open = max_open
+        self.max_buffered = max_buffered
+        self.buffered = 0
+        self.buffers = {}
+        self.sizes = {}
+        self.files = OrderedDict()
+        self.created = set()
+
+    def path(self, key):
+        return os.path.join(self.output_dir, '%s.log%s' % (
+            key, '.gz' if self.compress else ''))
+
+    def write(self, key, line):
+        try:
+            self.buffers[key].append(line)
+            self.sizes[key] += len(line)
+        except KeyError:
+            self.buffers[key] = [line]
+            self.sizes[key] = len(line)
+        self.buffered += len(line)
+        if self.sizes[key] >= self.buffer_size:
+            self.flush(key)
+        elif self.buffered > self.max_buffered:
+            self.flush(max(self.sizes, key=self.sizes.get))
+
+    def _file(self, key):
+        f = self.files.pop(key, None)
+        if f is None:
+            if len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+            mode = 'ab' if key in self.created else 'wb'
+            self.created.add(key)
+            if self.compress:
+                f = gzip.open(self.path(key), mode)
+            else:
+                f = open(self.path(key), mode)
+        self.files[key] = f
+        return f
+
+    def flush(self, key):
+        lines = self.buffers.pop(key, None)
+        self.buffered -= self.sizes.pop(key, 0)
+        if lines:
+            self._file(key).write(''.join(lines))
+
+    def close(self):
+        for key in self.buffers.keys():
+            self.flush(key)
+        for f in self.files.itervalues():
+            f.close()
+        self.files.clear()
+
+
+def access_line_timestamp(line):
+    """Utc timestamp of an apache2 access log line or None"""
+    i = line.find('[')
+    if i == -1:
+        return None
+    j = line.find(']', i)
+    if j == -1:
+        return None
+    return log2json.apache_timestamp(line[i + 1:j])
+
+
+def error_line_timestamp(line):
+    """Timestamp of an apache2 error log line or None. The time in
+    error logs has no timezone and is taken to be in UTC
+
+    """
+    if not line.startswith('['):
+        return None
+    parts = line[1:line.find(']')].split()
+    if len(parts) != 5:
+        return None
+    _, month, day, clock, year = parts
+    month = MONTHS.get(month.title())
+    try:
+        hour, minute, second = clock.split('.')[0].split(':')
+        return float(calendar.timegm((int(year), month, int(day), int(hour),
+                                      int(minute), int(second))))
+    except (ValueError, TypeError):
+        return None
+
+
+LINE_TIMESTAMPS = {
+    'apache2_access': access_line_timestamp,
+    'apache2_error': error_line_timestamp,
+}
+
+
+def parse_time_arg(value):
+    """Parses the time given for --from or --to to a utc timestamp
+
+    :param value: str, in one of TIME_ARG_FORMATS or a unix timestamp
+    :rtype: float
+
+    """
+    for fmt in TIME_ARG_FORMATS:
+        try:
+            dt = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return float(calendar.timegm(dt.timetuple()))
+    try:
+        return float(value)
+    except ValueError:
+        raise cli.CliError('Invalid time: %s' % (value,))
+
+
+def line_start(mm, pos):
+    """Offset of the beginning of the first line starting at or after
+    pos in the memory mapped file
+
+    """
+    if pos <= 0:
+        return 0
+    i = mm.find('\n', pos - 1)
+    return len(mm) if i == -1 else i + 1
+
+
+def line_end(mm, pos):
+    """Offset right after the line starting at pos"""
+    i = mm.find('\n', pos)
+    return len(mm) if i == -1 else i + 1
+
+
+def first_timestamp(mm, pos, end, get_timestamp):
+    """Timestamp of the first line starting between pos and end that
+    has one, or None
+
+    """
+    while pos < end:
+        stop = line_end(mm, pos)
+        ts = get_timestamp(mm[pos:stop])
+        if ts is not None:
+            return ts
+        pos = stop
+    return None
+
+
+def bisect_offset(mm, target, get_timestamp, min_span=BISECT_MIN_SPAN):
+    """Offset of the first line with a timestamp >= target in a memory
+    mapped log file ordered by time
+
+    Bisects on byte offsets, resyncing to the next line at every step,
+    until the span is small enough to be scanned line by line
+
+    :param mm: mmap.mmap object
+    :param target: float
+    :param get_timestamp: callable returning the timestamp of a line
+    :param min_span: int
+    :rtype: int
+
+    """
+    size = len(mm)
+    lo, hi = 0, size
+    while hi - lo > min_span:
+        mid = line_start(mm, (lo + hi) // 2)
+        if mid <= lo or mid >= hi:
+            break
+        ts = first_timestamp(mm, mid, hi, get_timestamp)
+        if ts is not None and ts < target:
+            lo = mid
+        else:
+            hi = mid
+    pos = lo
+    while pos < size:
+        stop = line_end(mm, pos)
+        ts = get_timestamp(mm[pos:stop])
+        if ts is not None and ts >= target:
+            return pos
+        pos = stop
+    return size
+
+
+def is_time_ordered(mm, get_timestamp, slack, probes=ORDER_PROBES):
+    """Checks if a memory mapped log file is ordered by time by
+    looking at evenly spaced lines. Lines may be out of order by up to
+    slack seconds, as happens when requests are logged as they finish
+
+    :rtype: bool
+
+    """
+    size = len(mm)
+    last = None
+    for i in xrange(probes):
+        pos = line_start(mm, size * i // probes)
+        ts = first_timestamp(mm, pos, size, get_timestamp)
+        if ts is None:
+            continue
+        if last is not None and ts < last - slack:
+            return False
+        last = ts if last is None else max(ts, last)
+    return True
+
+
+def read_slice(mm, begin, stop):
+    """Generator of the lines starting between begin and stop"""
+    mm.seek(begin)
+    while mm.tell() < stop:
+        yield mm.readline()
+
+
+def filter_time(lines, start, end, get_timestamp):
+    """Generator of the lines logged between start (inclusive) and end
+    (exclusive). Lines without a timestamp go along with the line
+    before them
+
+    :param lines: iterable of str
+    :param start: float or None
+    :param end: float or None
+    :param get_timestamp: callable returning the timestamp of a line
+    :rtype: generator of str
+
+    """
+    include = False
+    for line in lines:
+        ts = get_timestamp(line)
+        if ts is not None:
+            include = ((start is None or ts >= start) and
+                       (end is None or ts < end))
+        if include:
+            yield line
+
+
+def time_range(mm, start, end, get_timestamp, slack):
+    """Generator of the lines logged between start and end in a
+    memory mapped log file ordered by time
+
+    The slice of the file holding the range is found by bisection and
+    only that slice is read. The slice is widened by slack seconds on
+    both sides to cover lines that are slightly out of order. Falls
+    back to a scan of the complete file if the file isn't ordered
+
+    :param mm: mmap.mmap object
+    :param start: float or None
+    :param end: float or None
+    :param get_timestamp: callable returning the timestamp of a line
+    :param slack: float, seconds
+    :rtype: generator of str
+
+    """
+    if not is_time_ordered(mm, get_timestamp, slack):
+        begin, stop = 0, len(mm)
+    else:
+        begin = 0 if start is None else bisect_offset(mm, start - slack,
+                                                      get_timestamp)
+        stop = len(mm) if end is None else bisect_offset(mm, end + slack,
+                                                         get_timestamp)
+    for line in filter_time(read_slice(mm, begin, stop), start, end,
+                            get_timestamp):
+        yield line
+
+
+def range_main(args):
+    """Extracts the lines logged between --from and --to"""
+    start = parse_time_arg(args.from_time) if args.from_time else None
+    end = parse_time_arg(args.to_time) if args.to_time else None
+    get_timestamp = LINE_TIMESTAMPS[args.log_type]
+    filepath = mappable_input(args)
+    if filepath is not None:
+        def overlaps(ts, date):
+            return ((start is None or ts + INDEX_BUCKET > start) and
+                    (end is None or ts < end))
+        with memory_map(filepath) as mm:
+            runs = None
+            if args.index:
+                runs = get_index(filepath, mm, args.log_type)
+            if runs is not None:
+                lines = read_ranges(mm, index_ranges(runs, len(mm),
+                                                     overlaps))
+                sys.stdout.writelines(filter_time(lines, start, end,
+                                                  get_timestamp))
+            else:
+                sys.stdout.writelines(time_range(mm, start, end,
+                                                 get_timestamp, args.slack))
+    else:
+        # stdin, compressed and multiple files can't be bisected
+        with cli.read_input(args.filepath, args.stdin) as f:
+            sys.stdout.writelines(filter_time(f, start, end, get_timestamp))
+
 
+@contextmanager
+def memory_map(filepath):
+    """Contextmanager that memory maps a file for reading"""
+    with open(filepath, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mm
+        finally:
+            mm.close()
+
+
+def mappable_input(args):
+    """The input file if it's a single, non empty and uncompressed
+    file that can be memory mapped, else None
+
+    """
+    filepaths = cli.expand_paths(args.filepath) if args.filepath else []
+    if (len(filepaths) == 1 and cli.compression(filepaths[0]) is None and
+        os.path.getsize(filepaths[0]) > 0):
+        return filepaths[0]
+    return None
+
+
+def access_line_minute(line):
+    """Minute of an apache2 access log line as in the log eg.
+    `08/Nov/2012:13:15 +0000` or None
+
+    """
+    i = line.find('[')
+    if i == -1:
+        return None
+    j = line.find(']', i)
+    if j == -1:
+        return None
+    value = line[i + 1:j]
+    return value[:17] + value[20:]
+
+
+def access_minute_info(minute):
+    """Utc timestamp of the start of an apache2 access log minute and
+    its date in the log as `08/Nov/2012`
+
+    """
+    ts = log2json.apache_timestamp(minute[:17] + ':00' + minute[17:])
+    return ts, minute[:11]
+
+
+def error_line_minute(line):
+    """Minute of an apache2 error log line eg. `Nov 08 13:15 2012` or
+    None
+
+    """
+    if not line.startswith('['):
+        return None
+    parts = line[1:line.find(']')].split()
+    if len(parts) != 5:
+        return None
+    return ' '.join([parts[1], parts[2], parts[3][:5], parts[4]])
+
+
+def error_minute_info(minute):
+    """Utc timestamp of the start of an apache2 error log minute and
+    its date as `08/Nov/2012`
+
+    """
+    month, day, clock, year = minute.split()
+    ts = error_line_timestamp('[Mon %s %s %s:00 %s]' % (month, day, clock,
+                                                         year))
+    return ts, '%s/%s/%s' % (day, month.title(), year)
+
+
+LINE_MINUTES = {
+    'apache2_access': (access_line_minute, access_minute_info),
+    'apache2_error': (error_line_minute, error_minute_info),
+}
+
+
+def build_index(mm, log_type):
+    """Builds the time index of a memory mapped log file
+
+    The index is a list of runs of consecutive lines logged in the
+    same minute, each being the offset of its first line, the utc
+    timestamp of the start of the minute and the date in the log. A
+    time ordered log has one run per minute. Lines without a time are
+    part of the run of the line before them.
+
+    A log whose lines are mostly out of order would have about one run
+    per line, so building the index is given up once there are more
+    than INDEX_MAX_RUNS_PER_BUCKET runs per minute on average.
+
+    :param mm: mmap.mmap object
+    :param log_type: type of logs
+    :rtype: list of [offset, timestamp, date], or None if the log
+            can't be indexed
+
+    """
+    line_minute, minute_info = LINE_MINUTES[log_type]
+    runs = []
+    minutes = set()
+    current = None
+    mm.seek(0)
+    pos = 0
+    for line in iter(mm.readline, ''):
+        minute = line_minute(line)
+        if minute is not None and minute != current:
+            ts, date = minute_info(minute)
+            if ts is not None:
+                current = minute
+                runs.append([pos, ts, date])
+                minutes.add(ts)
+                if (len(runs) > INDEX_MIN_RUNS and
+                    len(runs) > INDEX_MAX_RUNS_PER_BUCKET * len(minutes)):
+                    return None
+        pos += len(line)
+    return runs
+
+
+def index_path(filepath):
+    return filepath + INDEX_EXT
+
+
+def load_index(filepath, log_type):
+    """Loads the sidecar index of a log file. Returns None if there's
+    no index or if it's stale ie. the size or the mtime of the log
+    file changed since it was built
+
+    :param filepath: str
+    :param log_type: type of logs
+    :rtype: dict, with the runs (None if the log can't be indexed) and
+            what they were built from, or None
+
+    """
     try:
+        with open(index_path(filepath)) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+    st = os.stat(filepath)
+    if (index.get('size') != st.st_size or index.get('mtime') != st.st_mtime
+        or index.get('log_type') != log_type
+        or index.get('bucket') != INDEX_BUCKET):
+        return None
+    return index
+
+
+def get_index(filepath, mm, log_type):
+    """Loads the sidecar index of a log file, building and saving it
+    first if needed
+
+    :param filepath: str
+    :param mm: mmap.mmap object of the file
+    :param log_type: type of logs
+    :rtype: list of runs, or None if the log can't be indexed
+
+    """
+    index = load_index(filepath, log_type)
+    if index is not None:
+        return index['runs']
+    st = os.stat(filepath)
+    runs = build_index(mm, log_type)
+    if runs is None:
+        print >> sys.stderr, ('%s is not ordered by time, reading it '
+                              'without an index' % (filepath,))
+    # the index is saved even if the log can't be indexed, so that it
+    # isn't tried again until the log changes
+    try:
+        with open(index_path(filepath), 'w') as f:
+            json.dump({'size': st.st_size, 'mtime': st.st_mtime,
+                       'log_type': log_type, 'bucket': INDEX_BUCKET,
+                       'runs': runs}, f)
+    except IOError as e:
+        print >> sys.stderr, 'Could not save the index of %s: %s' % (
+            filepath, e)
+    return runs
+
+
+def index_ranges(runs, size, predicate):
+    """Byte ranges of the runs for which predicate is true, with
+    adjacent ranges merged
+
+    :param runs: list of [offset, timestamp, date]
+    :param size: int, size of the log file
+    :param predicate: callable taking the timestamp and date of a run
+    :rtype: list of (start, end) tuples
+
+    """
+    ranges = []
+    for i, (offset, ts, date) in enumerate(runs):
+        if not predicate(ts, date):
+            continue
+        end = runs[i + 1][0] if i + 1 < len(runs) else size
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((offset, end))
+    return ranges
+
+
+def read_ranges(mm, ranges):
+    """Generator of the lines in the byte ranges of a memory mapped
+    file
+
+    """
+    for begin, stop in ranges:
+        for line in read_slice(mm, begin, stop):
+            yield line
+
+
+def partition_key(match, partition):
+    """Key of the partition of a line from the match of its date
+
+    :param match: SRE_Match object of a LOG_DATE_PATTERNS pattern
+    :param partition: str, one of `month`, `day` or `hour`
+    :rtype: str
+
+    """
+    parts = match.groupdict()
+    parts['month'] = MONTHS[parts['month'].title()]
+    return PARTITION_FORMATS[partition].format(**parts)
+
+
+def partition(f, writer, partition, log_type='apache2_access'):
+    """Routes each line to a partition in a single pass over the input
+
+    Lines without a date (eg. the continuation lines of multi line
+    errors) go to the partition of the line before them
+
+    :param f: iterable of lines
+    :param writer: PartitionWriter
+    :param partition: str, one of `month`, `day` or `hour`
+    :param log_type: type of logs
+    :rtype: None
+
+    """
+    pattern = LOG_DATE_PATTERNS[log_type]
+    key = UNKNOWN_PARTITION
+    for line in f:
+        match = pattern.match(line)
+        if match is not None:
+            key = partition_key(match, partition)
+        writer.write(key, line)
+
+
+def indexed_date_main(args, filepath):
+    """Extracts the lines matching the date wildcard using the index.
+    Returns False if the file can't be indexed"""
+    date_pattern = parse_date(args.date)
+    pattern = get_date_pattern(date_pattern, args.log_type)
+    date_re = re.compile('{day}/{month}/{year}$'.format(**date_pattern))
+    def matches(ts, date):
+        return date_re.match(date) is not None
+    with memory_map(filepath) as mm:
+        runs = get_index(filepath, mm, args.log_type)
+        if runs is None:
+            return False
+        lines = read_ranges(mm, index_ranges(runs, len(mm), matches))
+        print ''.join(split(lines, pattern))
+    return True
+
+
+def main(args):
+    try:
+        if args.from_time or args.to_time:
+            return range_main(args)
+        if args.date and args.index and not args.partition:
+            filepath = mappable_input(args)
+            if filepath is not None and indexed_date_main(args, filepath):
+                return
         with cli.read_input(args.filepath, args.stdin) as f:
-            print ''.join(split(f, pattern))
+            if args.partition:
+                if not os.path.isdir(args.output_dir):
+                    os.makedirs(args.output_dir)
+                writer = PartitionWriter(args.output_dir, args.compress)
+                try:
+                    partition(f, writer, args.partition, args.log_type)
+                finally:
+                    writer.close()
+            elif args.date:
+                pattern = get_date_pattern(parse_date(args.date),
+                                           args.log_type)
+                print ''.join(split(f, pattern))
+            else:
+                raise cli.CliError('One of date, --partition or '
+                                   '--from/--to required')
     except cli.CliError as e:
-        raise argparse.ArgumentError(args.filepath, str(e))
+        raise argparse.ArgumentError(None, str(e))
 
 
 def test():
@@ -67,12 +730,78 @@ def test():
     log = '183.82.25.178 - - [08/Nov/2012:13:15:05 +0000] "GET /favicon.ico HTTP/1.1" 404 503 "-" "Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:16.0) Gecko/20100101 Firefox/16.0"'
     assert cp.match(log) is not None
 
+    m = LOG_DATE_PATTERNS['apache2_access'].match(log)
+    assert partition_key(m, 'day') == '2012-11-08'
+    assert partition_key(m, 'hour') == '2012-11-08-13'
+    assert partition_key(m, 'month') == '2012-11'
+    err = '[Thu Nov 08 13:15:05 2012] [error] [client 1.2.3.4] File does not exist'
+    m = LOG_DATE_PATTERNS['apache2_error'].match(err)
+    assert partition_key(m, 'hour') == '2012-11-08-13'
+    assert error_line_timestamp(err) == 1352380505.0
+    assert access_line_timestamp(log) == 1352380505.0
+    assert parse_time_arg('2012-11-08T13:15:05') == 1352380505.0
+    assert parse_time_arg('08/Nov/2012:13:15:05') == 1352380505.0
+    assert get_date_pattern(parse_date('*/*/2012')).match(log) is not None
+
+    assert access_minute_info(access_line_minute(log)) == (1352380500.0,
+                                                           '08/Nov/2012')
+    assert error_minute_info(error_line_minute(err)) == (1352380500.0,
+                                                         '08/Nov/2012')
+    runs = [[0, 60.0, '01/Jan/1970'], [10, 120.0, '01/Jan/1970'],
+            [25, 60.0, '01/Jan/1970'], [40, 180.0, '01/Jan/1970']]
+    assert index_ranges(runs, 50, lambda ts, d: ts < 180) == [(0, 40)]
+    assert index_ranges(runs, 50, lambda ts, d: ts == 60) == [(0, 10), (25, 40)]
+
+    import shutil
+    import tempfile
+    import random
+    ordered = ['1.2.3.4 - - [08/Nov/2012:%02d:%02d:05 +0000] "GET / '
+               'HTTP/1.1" 200 5 "-" "curl"\n' % (i // 60, i % 60)
+               for i in range(30) for _ in range(100)]
+    shuffled = list(ordered)
+    random.Random(0).shuffle(shuffled)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        logfile = os.path.join(tmpdir, 'access.log')
+        for lines, indexed in ((ordered, True), (shuffled, False)):
+            with open(logfile, 'w') as f:
+                f.writelines(lines)
+            with memory_map(logfile) as mm:
+                runs = get_index(logfile, mm, 'apache2_access')
+                assert (runs is not None) == indexed
+                assert load_index(logfile, 'apache2_access')['runs'] == runs
+        # not tried again as long as the log doesn't change
+        assert get_index(logfile, None, 'apache2_access') is None
+        # an index that can't be saved is only used once
+        os.remove(index_path(logfile))
+        os.mkdir(index_path(logfile))
+        with open(logfile, 'w') as f:
+            f.writelines(ordered)
+        with memory_map(logfile) as mm:
+            assert len(get_index(logfile, mm, 'apache2_access')) == 30
+        writer = PartitionWriter(tmpdir, buffer_size=100, max_buffered=250)
+        for i in range(200):
+            writer.write('p%d' % (i % 20,), 'line %d\n' % (i,))
+            assert writer.buffered <= 250
+            assert writer.buffered == sum(writer.sizes.values())
+        writer.close()
+        with open(os.path.join(tmpdir, 'p7.log')) as f:
+            assert f.read() == ''.join('line %d\n' % (i,)
+                                       for i in range(7, 200, 20))
+    finally:
+        shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('date', help='Wild card pattern for date eg. 06/Nov/*, */Nov/*')
-    parser.add_argument('-f', '--filepath',
-                        help='path to the log file')
+    parser.add_argument('date', nargs='?',
+                        help='Wild card pattern for date eg. 06/Nov/*, */Nov/*')
+    parser.add_argument('-f', '--filepath', nargs='+',
+                        help=(
+                            'path to the log file, multiple paths and '
+                            'glob patterns are read one after the other '
+                            'and gzip, bz2 and xz files are decompressed'
+                        ))
     parser.add_argument('-i', '--stdin',
                         help='Use standard input', action='store_true')
     parser.add_argument('-t', '--log-type',
@@ -81,6 +810,38 @@ if __name__ == '__main__':
                             'predefined log pattern format for parsing logs'
                         ), default='apache2_access',
                         choices=LOG_PATTERN_FORMATS.keys())
+    parser.add_argument('-p', '--partition',
+                        help=(
+                            'Split the complete input in a single pass '
+                            'into one file per month, day or hour'
+                        ), choices=sorted(PARTITION_FORMATS.keys()))
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help='directory to write the partition files to')
+    parser.add_argument('-z', '--compress',
+                        help='gzip the partition files',
+                        action='store_true')
+    parser.add_argument('--from', dest='from_time',
+                        help=(
+                            'Extract the lines logged at or after this '
+                            'utc time eg. 2012-11-08T13:00'
+                        ))
+    parser.add_argument('--to', dest='to_time',
+                        help=(
+                            'Extract the lines logged before this utc '
+                            'time eg. 2012-11-08T14:00'
+                        ))
+    parser.add_argument('-x', '--index',
+                        help=(
+                            'Use a sidecar time index (%s file next to '
+                            'the log, built on first use) to read only '
+                            'the parts of the log matching the date or '
+                            'the range' % (INDEX_EXT,)
+                        ), action='store_true')
+    parser.add_argument('--slack', type=float, default=60,
+                        help=(
+                            'Seconds by which lines may be out of order '
+                            'in range mode'
+                        ))
 
     args = parser.parse_args()
     main(args)